@@ -2,7 +2,7 @@ import random
 from tkinter import *
 from PIL import Image, ImageDraw, ImageColor
 import os
-#from CalculCoordinates import *
+from CalculCoordinates import calculate_coordinates
 
 """
 This script contains the code for randomly creating pictures in .png format that the Players are shown in the game.
@@ -26,14 +26,14 @@ shapes = ["circle", "rectangle", "triangle"]
 # Settings for the picture
 size_pic = 300          # length of one side of the picture
 size_grid = 200         # length of one side of the grid
-dim = 4                 # number of possible positions per row and per column
+dim = 4                 # default number of possible positions per row and per column, see Picture for other sizes
 rel_blocks = 0.6        # how much of the length of one side of grid should be made up by lengths of the blocks
 
 
 # Calculate coordinates automatically: Use this when changing any of the settings for the picture above
 #coordinates = calculate_coordinates(size_pic, size_grid, dim, rel_blocks)
 
-# Use fixed coordinates (NOTE: works only for the default 4x4 grid)
+# Use fixed coordinates (NOTE: works only for the default 4x4 grid, the coordinates of other grid sizes are calculated)
 coordinates = {1:{1:([(55,55),(95,95)]),2:([(105,55),(145,95)]),3:([(155,55),(195,95)]),4:([(205,55),(245,95)])},
                2:{1:([(55,105),(95,145)]),2:([(105,105),(145,145)]),3:([(155,105),(195,145)]),4:([(205,105),(245,145)])},
                3:{1:([(55,155),(95,195)]),2:([(105,155),(145,195)]),3:([(155,155),(195,195)]),4:([(205,155),(245,195)])},
@@ -87,21 +87,31 @@ class Block:
 
 class Picture:
     """
-    Class for Pictures displaying blocks in different colours in a nxn grid (n as specified at the top of the file)
+    Class for Pictures displaying blocks in different colours in a nxn grid (n = dim, by default as specified at the top of the file)
     blocks_n: int number of blocks displayed, i.e. number of non-empty positions in the grid
     blocks: list of Block objects each corresponding to one block displayed in the picture
     grid: list[lists[]]: represents the nxn grid each sublist corresponds to one row and consists of Block objects and None 
     name: string name for the picture is given when saving it
+    dim: int number of possible positions per row and per column
+    coordinates: the coordinates of the positions in the grid for drawing the picture, see calculate_coordinates
     """
     
-    def __init__(self, complexity=(3,17), name="test"):
+    def __init__(self, complexity=None, name="test", dim=dim):
         """
         :param complexity: a tuple (min_n, max_n + 1) where min_n is the minimal number of blocks and max_n the maximal number of blocks that should be included in the picture
-                            default value: between 3 and and 16 blocks
+                            default value: between 3 and dim*dim blocks
         :param name: name for the saved file of the picture
-        default value complexity: at least three blocks and at most 16 blocks
+        :param dim: number of possible positions per row and per column
+        default value complexity: at least three blocks and at most 16 blocks for the default 4x4 grid
         default name: test.png
         """
+        if complexity is None:
+            complexity = (3, dim * dim + 1)
+        self.dim = dim
+        if dim == 4:
+            self.coordinates = coordinates
+        else:
+            self.coordinates = calculate_coordinates(size_pic, size_grid, dim, rel_blocks)
         self.block_n = random.choice(range(complexity[0], complexity[1]))
         self.blocks = self.create_blocks(self.block_n)
         self.grid = self.create_grid()
@@ -134,11 +144,11 @@ class Picture:
 
         # create a nxn grid with None at all positions 
         grid = []
-        while len(grid) < dim:
-            row = dim * [None]
+        while len(grid) < self.dim:
+            row = self.dim * [None]
             grid.append(row)
 
-        free_pos = [(i,j) for i in range(1,dim+1) for j in range(1,dim+1)]
+        free_pos = [(i,j) for i in range(1,self.dim+1) for j in range(1,self.dim+1)]
         
         # randomly shuffle all possible positions s.t. popping an element from the list will result in getting a randomly chosen element
         random.shuffle(free_pos)
@@ -168,6 +178,7 @@ class Picture:
         edge = (size_pic-size_grid)/2
         draw.rectangle([(edge,edge),(size_pic-edge,size_pic-edge)],fill="white",outline="black")
     
+        coordinates = self.coordinates
         for row in coordinates:
             for column in coordinates[row]:
 
@@ -224,7 +235,7 @@ class Picture:
             for field in spacetobemarked:
                 # spacetobemarked contains the coordinates w.r.t. the position in the grid: i.e. the index of the row and the column
                 # get the corresponding coordinates w.r.t. the complete picture as specified in coordinates
-                current_coor = coordinates[field[0]][field[1]]
+                current_coor = self.coordinates[field[0]][field[1]]
                 top_left = current_coor[0]
                 bottom_right = current_coor[1]
 
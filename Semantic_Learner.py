@@ -59,17 +59,19 @@ __email__ = "See the authors' websites"
 import re
 from collections import defaultdict
 from grammar import Grammar, rules, functions
-from learning import evaluate, SGD, LatentSGD
+from learning import evaluate, SGD, VectorizedSGD, LatentSGD
 import semdata as semdata
 
 
+# Topmost relation symbol, compiled only once for phi_sem:
+toprel_re = re.compile(r"^(and|exist)")
+
 def phi_sem(x, y):
     """Feature function defined over full trees. It tracks the topmost
     binary relation if there is one, and it tracks all the lexical 
     features."""
     d = defaultdict(float)
     # Topmost relation symbol:
-    toprel_re = re.compile(r"^(and|exist)")
     #match = toprel_re.search(y[0][1])
     match = toprel_re.search(y.formular)
     if match:
@@ -108,7 +110,7 @@ def evaluate_semparse(u,lfs,grammar,allparses): # We give evaluate_semparse an u
     semparse_train = [[x,y] for x, y, d in sem_utterance]
     semparse_test = [[x,y] for x, y, d in sem_utterance]        
     weights = evaluate(phi=phi_sem,      # We let evaluate return the weights and store them
-                       optimizer=SGD,
+                       optimizer=VectorizedSGD, # Same weights as SGD, but the candidates are featurized only once
                        train=semparse_train,
                        test=semparse_test,
                        classes=allparses,
@@ -0,0 +1,345 @@
+import time
+import random
+from floating_grammar import *
+from learning import SGD, VectorizedSGD
+from Semantic_Learner import phi_sem
+from world import allblocks_test
+from BlockPictureGenerator import Picture
+import grammar as cky_grammar
+
+"""
+Benchmarks for the floating parser in floating_grammar.py and the CKY parser in grammar.py
+The utterances are parsed with the crude lexicon, i.e. every word is mapped to every lexical rule like it is the case
+for new words in the game, and evaluated with respect to the example picture world2.jpg from world.py
+"""
+
+# utterances of increasing length used for the benchmarks of the CKY parser
+cky_utterances = [
+    'there is a triangle',
+    'there is a red triangle',
+    'there is a red triangle under a square',
+    'there is a red triangle under a blue square',
+    'there is a blue square over a yellow square over a red triangle',
+    'there is a red triangle under a blue square and there is a blue triangle'
+]
+
+# utterances of increasing length used for the benchmarks
+benchmark_utterances = [
+    'a triangle',
+    'two blue forms',
+    'a red circle',
+    'circle under a square',
+    'two forms and circle'
+]
+
+
+class LinearItemIndex:
+    """
+    Collection of ParseItems with the same interface as ItemIndex that compares a ParseItem with every
+    included ParseItem to find out whether an equivalent one is already included, i.e. how the floating parser
+    checked for duplicates before ItemIndex was used
+    """
+    def __init__(self):
+        self.items = []
+
+    def add(self, p_item):
+        if p_item in self:
+            return False
+        self.items.append(p_item)
+        return True
+
+    def remove(self, p_item):
+        self.items.remove(p_item)
+
+    def contains_key(self, key):
+        for pi in self.items:
+            if pi.key == key:
+                return True
+        return False
+
+    def __contains__(self, p_item):
+        for pi in self.items:
+            if pi.formula == p_item.formula and pi.component_set == p_item.component_set:
+                return True
+        return False
+
+    def __iter__(self):
+        return iter(list(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+
+class LinearGrammar(Grammar):
+    item_index = LinearItemIndex
+
+
+class ScanningCKYGrammar(cky_grammar.Grammar):
+    """
+    CKY grammar that looks at every rule to find the rules for a pair of categories, i.e. how allcombos worked
+    before the rules were indexed
+    """
+    def allcombos(self, c1, c2):
+        return [(mother, app_order) for left, right, mother, app_order in self.rules if left == c1 and right == c2]
+
+
+def load_test_picture():
+    """
+    loads the example picture from world.py into allblocks
+    :return: the Picture object
+    """
+    test_pic = Picture(name="./marked_pictures/world")
+    test_pic.grid = allblocks_test
+    create_all_blocks(test_pic)
+    cky_grammar.create_all_blocks(test_pic)
+    return test_pic
+
+
+def crude_grammar(utterance, grammar_class=Grammar, learned=False, level=None):
+    """
+    creates a grammar whose lexicon maps every word of the utterance to all crude lexical rules
+    :param utterance: string, the input utterance
+    :param grammar_class: Grammar or a subclass of it
+    :param learned: if True the rules that are in gold_lexicon_basic for a word get weight 1 as if they had been learned,
+                    otherwise all weights are 0
+    :param level: int, if given only the crude rules allowed at this level are used, see CrudeRules
+    :return: the grammar object
+    """
+    crude_rules = create_lex_rules() if level is None else CrudeRules(level).rules()
+    lexicon = {}
+    for word in utterance.split():
+        gold_rules = {(entry[0], entry[1]) for entry in gold_lexicon_basic.get(word, [])}
+        lexicon[word] = [(categorie, function, int(learned and (categorie, function) in gold_rules))
+                         for categorie, function, weight in crude_rules]
+    return grammar_class(lexicon, rules, functions)
+
+
+def time_parse(gram, utterance, **kwargs):
+    """
+    parses the utterance with the given grammar and measures the time needed
+    :param gram: a Grammar object
+    :param utterance: string, the input utterance
+    :param kwargs: further arguments for gram.gen, e.g. beam
+    :return: pair of the parse results and the time in seconds
+    """
+    start = time.perf_counter()
+    results = gram.gen(utterance, **kwargs)
+    return results, time.perf_counter() - start
+
+
+def result_keys(results):
+    """
+    :param results: list of ParseItems
+    :return: set of the formulas, components and guessed blocks of the ParseItems to compare the results of two
+            parsers
+    """
+    return {(p_item.formular, p_item.components, frozenset(p_item.guessed_blocks)) for p_item in results}
+
+
+def best_weight(results):
+    """
+    :param results: list of ParseItems
+    :return: the highest summed_weights of the ParseItems or None if there are none
+    """
+    return max((p_item.summed_weights for p_item in results), default=None)
+
+
+def benchmark_item_index(utterances=benchmark_utterances):
+    """
+    compares the floating parser using ItemIndex with the parser scanning all ParseItems for duplicates
+    :param utterances: list of strings
+    """
+    print("utterance\tresults\tindexed (s)\tlinear (s)\tsame results")
+    for u in utterances:
+        indexed, t_indexed = time_parse(crude_grammar(u), u)
+        linear, t_linear = time_parse(crude_grammar(u, LinearGrammar), u)
+        same = result_keys(indexed) == result_keys(linear)
+        print("{}\t{}\t{:.3f}\t{:.3f}\t{}".format(u, len(indexed), t_indexed, t_linear, same))
+
+
+def benchmark_beam(utterances=benchmark_utterances, beams=(5, 20, 100)):
+    """
+    compares the exhaustive floating parser with the beam mode for different beam widths
+    the weights of the gold rules are set to 1 so that the beam keeps the ParseItems built from them
+    recall is the proportion of the results of the exhaustive parser that are also found in beam mode and best the
+    highest summed_weights of all results
+    :param utterances: list of strings
+    :param beams: beam widths that should be compared
+    """
+    print("utterance\tbeam\tresults\trecall\tbest\tpruned\ttime (s)")
+    for u in utterances:
+        exhaustive, t_exhaustive = time_parse(crude_grammar(u, learned=True), u)
+        exhaustive_keys = result_keys(exhaustive)
+        print("{}\t-\t{}\t1.000\t{}\t0\t{:.3f}".format(u, len(exhaustive), best_weight(exhaustive), t_exhaustive))
+        for beam in beams:
+            gram = crude_grammar(u, learned=True)
+            results, t_beam = time_parse(gram, u, beam=beam)
+            recall = len(result_keys(results) & exhaustive_keys) / max(len(exhaustive_keys), 1)
+            print("{}\t{}\t{}\t{:.3f}\t{}\t{}\t{:.3f}".format(u, beam, len(results), recall, best_weight(results),
+                                                             gram.n_pruned, t_beam))
+
+
+def guess_weights(results):
+    """
+    :param results: list of ParseItems
+    :return: set of pairs of each guess (as in grouping) and the highest summed_weights of the ParseItems for it
+    """
+    groups, sorted_guesses = grouping(results)
+    return {(guess, groups[guess][0].summed_weights) for guess in sorted_guesses}
+
+
+def benchmark_merge(utterances=benchmark_utterances):
+    """
+    compares the exhaustive floating parser with the mode merging ParseItems with the same denotation
+    :param utterances: list of strings
+    """
+    print("utterance\tresults\tresults merged\tmerged\ttime (s)\ttime merged (s)\tsame guesses")
+    for u in utterances:
+        exhaustive, t_exhaustive = time_parse(crude_grammar(u, learned=True), u)
+        gram = crude_grammar(u, learned=True)
+        merged, t_merged = time_parse(gram, u, merge_equivalent=True)
+        same = guess_weights(exhaustive) == guess_weights(merged)
+        print("{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}\t{}".format(u, len(exhaustive), len(merged), gram.n_merged,
+                                                          t_exhaustive, t_merged, same))
+
+
+def benchmark_best(utterances=benchmark_utterances, ks=(1, 3, 10)):
+    """
+    compares the exhaustive floating parser followed by grouping with the best-first mode for the k best guesses
+    the weights of the gold rules are set to 1 as in benchmark_beam
+    same is True if the k best guesses of both have the same weights (guesses with the same weight can be ordered
+    differently)
+    :param utterances: list of strings
+    :param ks: numbers of guesses that should be compared
+    """
+    print("utterance\tk\ttime exhaustive (s)\ttime best-first (s)\tsame weights")
+    for u in utterances:
+        exhaustive, t_exhaustive = time_parse(crude_grammar(u, learned=True), u)
+        groups, sorted_guesses = grouping(exhaustive)
+        for k in ks:
+            gram = crude_grammar(u, learned=True)
+            start = time.perf_counter()
+            best_groups, best_guesses = gram.gen_best(u, k)
+            t_best = time.perf_counter() - start
+            same = [best_groups[guess][0].summed_weights for guess in best_guesses] == \
+                   [groups[guess][0].summed_weights for guess in sorted_guesses[:k]]
+            print("{}\t{}\t{:.3f}\t{:.3f}\t{}".format(u, k, t_exhaustive, t_best, same))
+
+
+def benchmark_prefilter(utterances=benchmark_utterances, n_pictures=3, complexity=(3, 4), level=2):
+    """
+    compares the exhaustive floating parser with the mode deferring the lexical rules that are empty on the picture
+    the pictures are small random pictures, on which most colours and shapes do not occur
+    :param utterances: list of strings
+    :param n_pictures: number of random pictures
+    :param complexity: complexity of the random pictures, see Picture
+    :param level: int, the crude rules allowed at this level are used, see CrudeRules; from level 3 on every word can
+                be a disjunction, so no lexical rule is deferred
+    """
+    print("picture\tutterance\tresults\tresults filtered\tdeferred\ttime (s)\ttime filtered (s)\tsame results")
+    for i in range(n_pictures):
+        context = EvaluationContext()
+        create_all_blocks(Picture(complexity=complexity, name="prefilter"), context)
+        for u in utterances:
+            exhaustive, t_exhaustive = time_parse(crude_grammar(u, level=level), u, context=context)
+            gram = crude_grammar(u, level=level)
+            filtered, t_filtered = time_parse(gram, u, context=context, prefilter=True)
+            same = result_keys(exhaustive) == result_keys(filtered)
+            print("{}\t{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}\t{}".format(i, u, len(exhaustive), len(filtered),
+                                                                  gram.n_deferred, t_exhaustive, t_filtered, same))
+
+
+def benchmark_levels(utterances=benchmark_utterances, levels=(1, 2, 3)):
+    """
+    compares the floating parser with all crude rules with the parser using only the crude rules allowed at a level
+    :param utterances: list of strings
+    :param levels: levels that should be compared
+    """
+    print("utterance\tlevel\tresults\ttime all rules (s)\ttime level rules (s)")
+    for u in utterances:
+        exhaustive, t_exhaustive = time_parse(crude_grammar(u), u)
+        for level in levels:
+            results, t_level = time_parse(crude_grammar(u, level=level), u)
+            print("{}\t{}\t{}\t{:.3f}\t{:.3f}".format(u, level, len(results), t_exhaustive, t_level))
+
+
+def benchmark_learning(utterances=benchmark_utterances, level=3, seed=0):
+    """
+    compares SGD with VectorizedSGD for learning from the parses of the guess with the highest weight as in the game
+    :param utterances: list of strings
+    :param level: int, the crude rules allowed at this level are used, see CrudeRules
+    :param seed: random seed used for both learners
+    """
+    print("utterance\tparses\ttime SGD (s)\ttime vectorized (s)\tsame weights")
+    for u in utterances:
+        parse = crude_grammar(u, level=level).gen(u)
+        groups, sorted_guesses = grouping(parse)
+        weights = []
+        times = []
+        for optimizer in (SGD, VectorizedSGD):
+            random.seed(seed)
+            start = time.perf_counter()
+            weights.append(optimizer(D=[[u, lf] for lf in groups[sorted_guesses[0]]], phi=phi_sem, classes=parse,
+                                     T=10, eta=0.1))
+            times.append(time.perf_counter() - start)
+        same = list(weights[0].items()) == list(weights[1].items())
+        print("{}\t{}\t{:.3f}\t{:.3f}\t{}".format(u, len(parse), times[0], times[1], same))
+
+
+def benchmark_cky(utterances=cky_utterances):
+    """
+    measures the time the CKY parser needs to build the packed parse forest with the rules looked up in the index and
+    with scanning all rules for different sentence lengths and lexical ambiguity, i.e. with the gold lexicon (one
+    lexical rule per word) and the crude lexicon (all lexical rules for every word)
+    the number of parse trees is counted in the forest without building the trees
+    :param utterances: list of strings
+    """
+    crude_rules = cky_grammar.create_lex_rules()
+    print("lexicon\twords\ttrees\tindexed (s)\tscanning (s)")
+    for lexicon_name in ("gold", "crude"):
+        for u in utterances:
+            if lexicon_name == "gold":
+                lexicon = cky_grammar.gold_lexicon
+            else:
+                lexicon = {word: crude_rules for word in u.split()}
+            times = []
+            for grammar_class in (cky_grammar.Grammar, ScanningCKYGrammar):
+                gram = grammar_class(lexicon, cky_grammar.rules, cky_grammar.functions)
+                start = time.perf_counter()
+                gram.gen(u, max_trees=0)
+                times.append(time.perf_counter() - start)
+            trees = gram.count_trees(("V", 0, len(u.split())))
+            print("{}\t{}\t{}\t{:.4f}\t{:.4f}".format(lexicon_name, len(u.split()), trees, *times))
+
+
+def benchmark_grid(dims=(4, 16, 64), utterance='there is a red triangle under a blue square'):
+    """
+    measures how the evaluation scales with the size of the grid: for every grid size a picture with blocks at half of
+    the positions is created and the utterance is parsed with the gold lexicon of the CKY parser
+    the time for loading the picture includes indexing the blocks and computing their bitmasks
+    :param dims: numbers of positions per row and per column
+    :param utterance: string, the input utterance
+    """
+    print("grid\tblocks\tload (s)\tparse (s)\tresults")
+    for dim in dims:
+        n_blocks = dim * dim // 2
+        pic = Picture(complexity=(n_blocks, n_blocks + 1), name="grid", dim=dim)
+        start = time.perf_counter()
+        cky_grammar.create_all_blocks(pic)
+        t_load = time.perf_counter() - start
+        gram = cky_grammar.Grammar(cky_grammar.gold_lexicon, cky_grammar.rules, cky_grammar.functions)
+        results, t_parse = time_parse(gram, utterance)
+        print("{}x{}\t{}\t{:.4f}\t{:.4f}\t{}".format(dim, dim, n_blocks, t_load, t_parse, len(results)))
+
+
+if __name__ == "__main__":
+    load_test_picture()
+    benchmark_item_index()
+    benchmark_beam()
+    benchmark_merge()
+    benchmark_best()
+    benchmark_prefilter()
+    benchmark_levels()
+    benchmark_learning()
+    benchmark_cky()
+    benchmark_grid()
@@ -2,75 +2,441 @@
 This file defines the methods used in the functions of the grammar in grammar.py
 They are used to find the blocks in the Picture object described in the input utterance
 """
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from operator import attrgetter
 
 
-def position_test(blocks, block_locations, number, position):
+class BlockList(list):
+    """
+    List of Block objects that are the referenced blocks of a (sub)formula
+    back_track: dictionary that maps a Block object to the blocks it stands in the described relation to, i.e. the
+                relations that were found by position_test while computing the referenced blocks, as a tuple of
+                iterables of Block objects (RelatedBlocks), whose union are the related blocks
+                it is used to find the guessed blocks and is never changed after the BlockList was created so that
+                BlockLists can be shared between formulas
+    """
+    def __init__(self, blocks=(), back_track=None):
+        """
+        :param blocks: iterable of Block objects
+        :param back_track: dictionary mapping Block objects to tuples of iterables of Block objects or None
+        """
+        super().__init__(blocks)
+        self.back_track = back_track if back_track is not None else {}
+
+
+class RelatedBlocks:
+    """
+    The blocks a block stands in a relation to as found by position_test: the slice located[lo:hi] of the sorted
+    block_locations, without the block at column x (i.e. the block itself) for "next"
+    Only the bounds are stored in the back_track instead of the set of these blocks, so that position_test does not
+    copy up to m blocks for each of its n blocks; the blocks are only iterated when the guessed blocks are computed
+    """
+    __slots__ = ('located', 'lo', 'hi', 'x')
+
+    def __init__(self, located, lo, hi, x=None):
+        """
+        :param located: list of Block objects sorted by row or column
+        :param lo: int, index of the first related block in located
+        :param hi: int, index after the last related block in located
+        :param x: int, column of the block that is left out or None
+        """
+        self.located = located
+        self.lo = lo
+        self.hi = hi
+        self.x = x
+
+    def __iter__(self):
+        located = self.located
+        x = self.x
+        for i in range(self.lo, self.hi):
+            if located[i].x != x:
+                yield located[i]
+
+
+def related(parts):
+    """
+    :param parts: a value of a back_track, i.e. a tuple of iterables of Block objects
+    :return: iterator over the related blocks (a block can occur more than once)
+    """
+    return chain.from_iterable(parts)
+
+
+def get_back_track(blocks):
+    """
+    :param blocks: a BlockList or any other list of Block objects
+    :return: the back_track dictionary of blocks, empty if blocks is not a BlockList
+    """
+    return getattr(blocks, "back_track", {})
+
+
+class AttributeCondition:
+    """
+    Condition of block_filter that tests whether an attribute of a block has a certain value, e.g. b.shape == "circle"
+    It can be called on a block like any other condition, but block_filter looks up the blocks fulfilling it in the
+    AttributeIndex of the picture instead (see has_colour and has_shape)
+    attribute: string, "colour" or "shape"
+    value: the value of the attribute, e.g. "circle"
+    """
+    __slots__ = ('attribute', 'value')
+
+    def __init__(self, attribute, value):
+        self.attribute = attribute
+        self.value = value
+
+    def __call__(self, b):
+        return getattr(b, self.attribute) == self.value
+
+
+def has_colour(colour):
+    """
+    :param colour: string, e.g. "red"
+    :return: AttributeCondition that is True for the blocks with this colour
+    """
+    return AttributeCondition("colour", colour)
+
+
+def has_shape(shape):
+    """
+    :param shape: string, e.g. "triangle"
+    :return: AttributeCondition that is True for the blocks with this shape
+    """
+    return AttributeCondition("shape", shape)
+
+
+class AttributeIndex:
+    """
+    Inverted colour x shape index of the blocks of a picture, built once when the picture is loaded into an
+    EvaluationContext, so that block_filter looks up the blocks with a colour and/or shape instead of calling a
+    condition on every block
+    blocks: the list of all Block objects of the picture that was indexed
+    position: dictionary mapping the Block objects of the picture to their position in blocks
+    cells: dictionary mapping pairs (colour, shape) to the list of blocks with this colour and shape
+    lookups: dictionary mapping pairs (colour, shape), where None stands for any value, to the list and the frozenset
+             of the blocks found for them
+    """
+    def __init__(self):
+        self.blocks = []
+        self.position = {}
+        self.cells = {}
+        self.lookups = {}
+
+    def update(self, blocks):
+        """
+        indexes the blocks of a new picture
+        :param blocks: list of all Block objects of the picture
+        """
+        self.blocks = blocks
+        self.position = {b: i for i, b in enumerate(blocks)}
+        self.cells = {}
+        self.lookups = {}
+        for b in blocks:
+            self.cells.setdefault((b.colour, b.shape), []).append(b)
+
+    def lookup(self, colour=None, shape=None):
+        """
+        :param colour: string or None for any colour
+        :param shape: string or None for any shape
+        :return: list of the blocks of the picture with colour and shape in the order of blocks and the frozenset of
+                these blocks
+        """
+        key = (colour, shape)
+        found = self.lookups.get(key)
+        if found is None:
+            matching = []
+            for (c, s), cell in self.cells.items():
+                if colour in (None, c) and shape in (None, s):
+                    matching.extend(cell)
+            matching.sort(key=self.position.__getitem__)
+            found = (matching, frozenset(matching))
+            self.lookups[key] = found
+        return found
+
+    def select(self, conditions, blocks):
+        """
+        finds the blocks fulfilling attribute conditions
+        :param conditions: list of AttributeConditions on the colour and shape of the blocks
+        :param blocks: list of Block objects
+        :return: list of the blocks from blocks that fulfill all conditions or None if any of the blocks is not
+                part of the indexed picture
+        """
+        values = {"colour": None, "shape": None}
+        for c in conditions:
+            if values[c.attribute] not in (None, c.value):
+                # e.g. a block can not be red and blue
+                return []
+            values[c.attribute] = c.value
+        matching, members = self.lookup(values["colour"], values["shape"])
+
+        if blocks is self.blocks:
+            return matching
+        if not all(map(self.position.__contains__, blocks)):
+            return None
+        return [b for b in blocks if b in members]
+
+
+class BlockSet(int):
+    """
+    Set of blocks of a picture represented as a bitmask, the bitset counterpart of BlockList used by the bitset
+    backend (see bitset_backend)
+    bit i is set if the i-th block of bits.blocks is a referenced block
+    back_track: dictionary that maps the index of a block to the bitmask of the blocks it stands in the described
+                relation to, i.e. the same as the back_track of a BlockList
+    bits: the BlockBits of the picture
+    """
+    def __new__(cls, mask, bits, back_track=None):
+        """
+        :param mask: int, bitmask of the referenced blocks
+        :param bits: BlockBits of the picture
+        :param back_track: dictionary mapping indices of blocks to bitmasks or None
+        """
+        block_set = super().__new__(cls, mask)
+        block_set.bits = bits
+        block_set.back_track = back_track if back_track is not None else {}
+        return block_set
+
+    def __len__(self):
+        return self.bit_count()
+
+    def __iter__(self):
+        return iter(self.bits.blocks_of(self))
+
+
+def set_bits(mask):
+    """
+    :param mask: int, a bitmask
+    :return: generator of the indices of the set bits of mask in ascending order
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BlockBits:
+    """
+    Bitmasks of the blocks of a picture for the bitset backend, computed once when the picture is loaded into an
+    EvaluationContext
+    blocks: list of the Block objects of the picture, the i-th block is represented by bit i
+    index: dictionary mapping the Block objects to their index
+    full: bitmask of all blocks of the picture
+    attributes: dictionary mapping pairs (attribute, value), e.g. ("colour", "red"), to the bitmask of the blocks with
+                this colour or shape
+    relations: dictionary mapping the positions "u", "o", "n", "l", "r" to a list with the bitmask of the blocks
+               the i-th block stands in that relation to
+    """
+    def __init__(self):
+        self.blocks = []
+        self.index = {}
+        self.full = 0
+        self.attributes = {}
+        self.relations = {}
+
+    def update(self, blocks):
+        """
+        computes the bitmasks for a new picture
+        the relations are computed from the bitmasks of the rows and columns: going through the rows from top to bottom,
+        the blocks of a row are under all blocks of the rows before, and the same for the other directions
+        :param blocks: list of all Block objects of the picture
+        """
+        self.blocks = list(blocks)
+        self.index = {b: i for i, b in enumerate(self.blocks)}
+        self.full = (1 << len(self.blocks)) - 1
+        self.attributes = {}
+        for i, b in enumerate(self.blocks):
+            for key in (("colour", b.colour), ("shape", b.shape)):
+                self.attributes[key] = self.attributes.get(key, 0) | 1 << i
+
+        rows = {}
+        columns = {}
+        for i, b in enumerate(self.blocks):
+            rows[b.y] = rows.get(b.y, 0) | 1 << i
+            columns[b.x] = columns.get(b.x, 0) | 1 << i
+        self.relations = {"n": [rows[b.y] & ~(1 << i) for i, b in enumerate(self.blocks)]}
+        for position, lines, reverse in (("u", rows, False), ("o", rows, True), ("r", columns, False),
+                                         ("l", columns, True)):
+            masks = [0] * len(self.blocks)
+            before = 0
+            for line in sorted(lines, reverse=reverse):
+                for i in set_bits(lines[line]):
+                    masks[i] = before
+                before |= lines[line]
+            self.relations[position] = masks
+
+    def mask(self, blocks):
+        """
+        :param blocks: iterable of Block objects of the picture
+        :return: int, bitmask of the blocks
+        """
+        index = self.index
+        mask = 0
+        for b in blocks:
+            mask |= 1 << index[b]
+        return mask
+
+    def blocks_of(self, mask):
+        """
+        :param mask: int, bitmask of blocks of the picture
+        :return: list of the Block objects
+        """
+        blocks = self.blocks
+        return [blocks[i] for i in set_bits(mask)]
+
+    def block_set(self, blocks):
+        """
+        converts a list of blocks into a BlockSet, the back_track of a BlockList is converted as well
+        :param blocks: BlockSet, BlockList or any other list of Block objects of the picture
+        :return: BlockSet
+        """
+        if isinstance(blocks, BlockSet):
+            return blocks
+        index = self.index
+        back_track = {index[b]: self.mask(related(parts)) for b, parts in get_back_track(blocks).items()}
+        return BlockSet(self.mask(blocks), self, back_track)
+
+
+class PositionIndex:
+    """
+    Ranks of the rows and columns of the blocks of a picture, built once when the picture is loaded into an
+    EvaluationContext, so that position_test orders block_locations by row or column with a bucket sort over these
+    ranks instead of sorting them for every formula
+    ranks: dictionary mapping the axis "y" (rows) and "x" (columns) to a dictionary mapping the Block objects of the
+           picture to the rank of their row or column among the distinct rows or columns of the picture
+    n_lines: dictionary mapping the axis to the number of distinct rows or columns of the picture
+    """
+    def __init__(self):
+        self.ranks = {"y": {}, "x": {}}
+        self.n_lines = {"y": 0, "x": 0}
+
+    def update(self, blocks):
+        """
+        indexes the blocks of a new picture
+        :param blocks: list of all Block objects of the picture
+        """
+        for axis in ("y", "x"):
+            coordinate = attrgetter(axis)
+            lines = {line: rank for rank, line in enumerate(sorted({coordinate(b) for b in blocks}))}
+            self.ranks[axis] = {b: lines[coordinate(b)] for b in blocks}
+            self.n_lines[axis] = len(lines)
+
+    def locate(self, blocks, axis):
+        """
+        sorts blocks by row or column
+        :param blocks: list of Block objects
+        :param axis: "y" to sort by row, "x" to sort by column
+        :return: pair of the sorted list of the blocks and a list whose k-th entry is the number of blocks in the rows
+                or columns with a rank less than k (for k from 0 to n_lines), or None if any of the blocks is not part
+                of the indexed picture
+        """
+        ranks = self.ranks[axis]
+        lines = [[] for _ in range(self.n_lines[axis])]
+        for b in blocks:
+            rank = ranks.get(b)
+            if rank is None:
+                return None
+            lines[rank].append(b)
+        starts = [0]
+        for line in lines:
+            starts.append(starts[-1] + len(line))
+        return list(chain.from_iterable(lines)), starts
+
+
+def position_test(blocks, block_locations, number, position, index=None):
     """
     finds all pairs of blocks b1 and b2 from blocks and block_locations respectively
     that stand in relation position to eachother and checks if number of blocks is true
     e.g. blocks is a list of all blue rectangles and block_locations a list of all red circles, number is 2, position is 'u'
-    then the function returns the list of all blocks that are blue rectangles and are below 2 red circles and updates the
-    back_track attribute of each of those blue rectangles by adding the red circles that make the description true w.r.t
-    the specific blue rectangle
+    then the function returns the list of all blocks that are blue rectangles and are below 2 red circles and
+    the back_track of the returned list maps each of those blue rectangles to the red circles that make the description
+    true w.r.t the specific blue rectangle
+    block_locations is sorted by row (or column for "l" and "r") once, so that the blocks of block_locations each block
+    of blocks stands in relation position to are a slice of it
+    if the PositionIndex of the picture is given, block_locations is sorted by the ranks of the rows or columns in the
+    index and the bounds of the slices are looked up by these ranks, i.e. the numbers of related blocks are found in
+    O(n + m) for n blocks and m block_locations; otherwise (or if any block is not part of the indexed picture)
+    block_locations is sorted by its coordinates and the bounds are found by binary search in O((n + m) log m)
+    the back_track only stores the bounds of these slices (see RelatedBlocks), the related blocks themselves are only
+    iterated by guesses_of
     :param blocks: list of blocks are the referenced block
     :param block_locations: list of blocks are the referenced blocks
     :param number: the number of blocks from block_locations that should fulfill the relation
     :param position: string for the relative position
-    :return: list of all blocks from blocks that stand in relation position to any block in block_locations
+    :param index: PositionIndex of the picture or None
+    :return: BlockList of all blocks from blocks that stand in relation position to any block in block_locations
     """
     ref_blocks1 = blocks
     ref_blocks2 = block_locations
 
-    fulfill_ref = set()
+    # the relations found for blocks and block_locations are kept for backtracking the guessed blocks
+    back_track = {}
+    for old_back_track in (get_back_track(ref_blocks1), get_back_track(ref_blocks2)):
+        for b, parts in old_back_track.items():
+            back_track[b] = back_track.get(b, ()) + parts
 
-    matching_combs = []
+    axis = "x" if position in ("l", "r") else "y"
+    located = None
+    if index is not None and all(map(index.ranks[axis].__contains__, ref_blocks1)):
+        located = index.locate(ref_blocks2, axis)
+    if located is not None:
+        # the blocks of block_locations in the rows (or columns) with a smaller rank than the one of a block are
+        # located[:starts[rank]], the ones in the same row located[starts[rank]:starts[rank + 1]]
+        located, starts = located
+        line = index.ranks[axis].__getitem__
+    else:
+        line = attrgetter(axis)
+        located = sorted(ref_blocks2, key=line)
+        coordinates = [line(b2) for b2 in located]
+        starts = None
+    # for "n" the block at the same position is not next to a block
+    positions = {(b2.y, b2.x) for b2 in located} if position == "n" else set()
 
+    fulfill_ref = BlockList(back_track=back_track)
     for b1 in ref_blocks1:
-        matching_b2 = set()
-
-        for b2 in ref_blocks2:
+        c = line(b1)
+        # located[:before] are in the rows (or columns) before the one of b1, located[before:after] in the same one
+        if starts is not None:
+            before, after = starts[c], starts[c + 1]
+        else:
+            before, after = bisect_left(coordinates, c), bisect_right(coordinates, c)
+        x = None
+        # "u" and "r": blocks with a smaller y or x coordinate, "o" and "l": blocks with a greater one
+        if position in ("u", "r"):
+            lo, hi = 0, before
+        elif position in ("o", "l"):
+            lo, hi = after, len(located)
+        elif position == "n":
+            lo, hi = before, after
+            x = b1.x
+        else:
+            lo, hi = 0, 0
+        n_matching = hi - lo - ((b1.y, b1.x) in positions)
 
-            match = False
-            if position == "u" and b1.y > b2.y:
-                match = True
-
-            elif position == "o" and b1.y < b2.y:
-                match = True
-
-            elif position == "n":
-                if b1.y == b2.y and (not b1.x == b2.x):
-                    match = True
-
-            elif position == "l" and b1.x < b2.x:
-                match = True
-
-            elif position == "r" and b1.x > b2.x:
-                match = True
-
-            if match == True:
-                matching_b2.add(b2)
-                b1.keep_track(b2)
-
-        if matching_b2 != []:
-            matching_combs.append((b1,matching_b2))
-
-    for b1,b2s in matching_combs:
-        if len(b2s) in number:
-            fulfill_ref.add(b1)
-
-    fulfill_ref = list(fulfill_ref)
+        if n_matching:
+            back_track[b1] = back_track.get(b1, ()) + (RelatedBlocks(located, lo, hi, x),)
+        if n_matching in number:
+            fulfill_ref.append(b1)
 
     return fulfill_ref
 
 
-def block_filter(conditions, blocks):
+def block_filter(conditions, blocks, index=None):
     """
     checks which blocks match a certain condition such as shape == rectangle or color == green
+    if the AttributeIndex of the picture is given, conditions on the colour or shape (see has_colour and has_shape) are
+    looked up in it, all other conditions are called for every remaining block
     :param conditions: list of conditions
     :param blocks: list of blocks are the referenced blocks
-    :return: list of referenced blocks fulfilling the conditions
+    :param index: AttributeIndex of the picture or None
+    :return: BlockList of referenced blocks fulfilling the conditions, with the back_track of blocks
     """
-    fulfill_ref = []
+    fulfill_ref = BlockList(back_track=get_back_track(blocks))
+
+    attribute_conditions = [c for c in conditions if type(c) is AttributeCondition]
+    if attribute_conditions and index is not None:
+        selected = index.select(attribute_conditions, blocks)
+        if selected is not None:
+            blocks = selected
+            conditions = [c for c in conditions if type(c) is not AttributeCondition]
 
     for b in blocks:
         test = True
@@ -80,4 +446,309 @@ def block_filter(conditions, blocks):
         if test:
             fulfill_ref.append(b)
 
-    return fulfill_ref
\ No newline at end of file
+    return fulfill_ref
+
+
+def bitset_filter(conditions, blocks, bits):
+    """
+    does the same as block_filter for the bitset backend, the blocks fulfilling conditions on the colour or shape are
+    looked up in bits
+    :param conditions: list of conditions
+    :param blocks: BlockSet or list of Block objects of the picture, i.e. the referenced blocks
+    :param bits: BlockBits of the picture
+    :return: BlockSet of referenced blocks fulfilling the conditions, with the back_track of blocks
+    """
+    blocks = bits.block_set(blocks)
+    candidates = int(blocks)
+    other_conditions = []
+    for c in conditions:
+        if isinstance(c, AttributeCondition):
+            candidates &= bits.attributes.get((c.attribute, c.value), 0)
+        else:
+            other_conditions.append(c)
+    if not other_conditions:
+        return BlockSet(candidates, bits, blocks.back_track)
+
+    all_blocks = bits.blocks
+    mask = 0
+    for i in set_bits(candidates):
+        b = all_blocks[i]
+        if all(c(b) for c in other_conditions):
+            mask |= 1 << i
+    return BlockSet(mask, bits, blocks.back_track)
+
+
+def bitset_position_test(blocks, block_locations, number, position, bits):
+    """
+    does the same as position_test for the bitset backend
+    :param blocks: BlockSet, the referenced blocks
+    :param block_locations: BlockSet, the referenced blocks
+    :param number: the number of blocks from block_locations that should fulfill the relation
+    :param position: string for the relative position
+    :param bits: BlockBits of the picture
+    :return: BlockSet of all blocks from blocks that stand in relation position to number blocks in block_locations
+    """
+    back_track = dict(blocks.back_track)
+    for i, matching in block_locations.back_track.items():
+        back_track[i] = back_track.get(i, 0) | matching
+
+    relation = bits.relations[position]
+    fulfill_ref = 0
+    for i in set_bits(blocks):
+        matching = relation[i] & block_locations
+        if matching:
+            back_track[i] = back_track.get(i, 0) | matching
+        if matching.bit_count() in number:
+            fulfill_ref |= 1 << i
+    return BlockSet(fulfill_ref, bits, back_track)
+
+
+def bitset_guesses(blocks):
+    """
+    does the same as guesses_of for the bitset backend
+    :param blocks: BlockSet, the referenced blocks
+    :return: int, bitmask of the guessed blocks
+    """
+    back_track = blocks.back_track
+    guesses = 0
+    new = int(blocks)
+    while new:
+        guesses |= new
+        matching = 0
+        for i in set_bits(new):
+            matching |= back_track.get(i, 0)
+        new = matching & ~guesses
+    return guesses
+
+
+class BitsetFunctions(dict):
+    """
+    Functions mapping of a grammar whose logical forms are evaluated with the bitset backend, i.e. the blocks are
+    represented as BlockSets instead of BlockLists, see bitset_backend
+    """
+
+
+def bitset_backend(functions):
+    """
+    creates the functions mapping for the bitset backend from the functions of a grammar: block_filter, the colour
+    and the position functions are replaced by their bitset versions, all other functions (e.g. exist, und) work
+    for both backends
+    a grammar created with the returned mapping gives the same results as with functions
+    :param functions: dictionary mapping the names used in the logical forms to functions of an EvaluationContext
+    :return: BitsetFunctions
+    """
+    replaced = {
+        'block_filter': (lambda context: lambda conditions, blocks:
+                         bitset_filter(conditions, blocks, context.block_bits)),
+        'anycol': (lambda context: lambda x: bitset_filter([], x, context.block_bits))
+    }
+    for colour in ("blue", "red", "green", "yellow"):
+        replaced[colour] = (lambda colour: lambda context: lambda x:
+                            bitset_filter([has_colour(colour)], x, context.block_bits))(colour)
+    for name, position in (("under", "u"), ("over", "o"), ("next", "n"), ("left", "l"), ("right", "r")):
+        replaced[name] = (lambda position: lambda context: lambda n: lambda x: lambda y:
+                          bitset_position_test(y, x, n, position, context.block_bits))(position)
+
+    bitset_functions = BitsetFunctions(functions)
+    for name, function in replaced.items():
+        if name in functions:
+            bitset_functions[name] = function
+    return bitset_functions
+
+
+def denotation_key(blocks):
+    """
+    :param blocks: a BlockSet, BlockList or any other list of Block objects
+    :return: hashable representation of the referenced blocks together with their back_track, two lists of blocks with
+            the same key have the same meaning when they are used in a formula
+            (for a BlockList the related blocks of the back_track are iterated to build the key)
+    """
+    if isinstance(blocks, BlockSet):
+        return int(blocks), frozenset(blocks.back_track.items())
+    return frozenset(blocks), frozenset((b, frozenset(related(parts))) for b, parts in get_back_track(blocks).items())
+
+
+def guesses_of(blocks):
+    """
+    finds the guessed blocks for a list of referenced blocks by recursively backtracking all blocks that the
+    referenced blocks stand in a relation to
+    :param blocks: a BlockSet, BlockList or any other list of Block objects, i.e. the referenced blocks
+    :return: set of Block objects
+    """
+    if isinstance(blocks, BlockSet):
+        return set(blocks.bits.blocks_of(bitset_guesses(blocks)))
+
+    back_track = get_back_track(blocks)
+    guesses = set()
+    stack = list(blocks)
+
+    while stack != []:
+        b = stack.pop()
+        if b in guesses:
+            continue
+        guesses.add(b)
+        stack.extend(related(back_track.get(b, ())))
+    return guesses
+
+
+def guess_key(guesses):
+    """
+    :param guesses: the guessed blocks of a formula, see EvaluationContext.take_guesses
+    :return: the key by which formulas with the same guessed blocks are grouped: the BlockSet itself for the bitset
+            backend, so that the guesses are hashed and compared as bitmasks, a frozenset of the Block objects otherwise
+    """
+    if isinstance(guesses, BlockSet):
+        return guesses
+    return frozenset(guesses)
+
+
+class DenotationCache:
+    """
+    Stores the denotations of (sub)formulas with respect to a picture, so that a subformula that is shared by several
+    formulas (e.g. red(block_filter([], allblocks))) is only computed once per picture
+    Only BlockLists and BlockSets are stored as computing them does not have any side effects, all other denotations
+    (functions, numbers and truth values) are computed each time
+    The cache has to be cleared whenever a new picture is loaded
+    denotations: dictionary mapping string representations of formulas to their BlockList or BlockSet
+    hits: int, number of times a denotation was found in the cache
+    misses: int, number of times a denotation had to be computed and was stored in the cache
+    """
+    def __init__(self):
+        self.denotations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def denotation(self, str_form, evaluate, *args):
+        """
+        returns the denotation of a formula from the cache or computes it if it is not stored yet
+        :param str_form: string representation of the formula
+        :param evaluate: function that computes the denotation of the formula
+        :param args: the arguments evaluate is called with
+        :return: the denotation
+        """
+        denotation = self.denotations.get(str_form)
+        if denotation is not None:
+            self.hits += 1
+            return denotation
+        denotation = evaluate(*args)
+        if isinstance(denotation, (BlockList, BlockSet)):
+            self.misses += 1
+            self.denotations[str_form] = denotation
+        return denotation
+
+    def clear(self):
+        """
+        removes all stored denotations, the counters are not reset
+        """
+        self.denotations.clear()
+
+
+class EvaluationContext:
+    """
+    Everything the evaluation of the logical forms depends on apart from the formulas: the blocks of one picture, the
+    indices of the blocks, the denotations computed for them and the guessed blocks of the formula that is evaluated
+    The logical forms are evaluated in the context passed to Grammar.sem, so several pictures can be evaluated in one
+    process, also in parallel threads if each thread uses its own context (and its own Grammar, as a Grammar keeps the
+    parse chart of the utterance it parses)
+    The relations found by position_test are only stored in the back_track of the BlockLists (or BlockSets) and
+    no Block object is changed during the evaluation
+    blocks: list of all Block objects of the picture, i.e. allblocks in the logical forms
+    guesses: set of the guessed blocks added by exist while a formula is evaluated, see update_guess
+    guess_mask: int, bitmask of the guessed blocks added by exist for the BlockSets of the bitset backend
+    attribute_index: AttributeIndex of the blocks
+    position_index: PositionIndex of the blocks
+    block_bits: BlockBits of the blocks for the bitset backend
+    denotation_cache: DenotationCache for the denotations of the subformulas w.r.t. the blocks
+    bitset_cache: the same for the grammars using the bitset backend as their denotations are BlockSets
+    bound: dictionary mapping the id of a functions mapping to the pair of the mapping and the names of the logical
+           forms bound to this context, see names
+    """
+    def __init__(self, blocks=()):
+        """
+        :param blocks: iterable of all Block objects of the picture
+        """
+        self.blocks = []
+        self.guesses = set()
+        self.guess_mask = 0
+        self.attribute_index = AttributeIndex()
+        self.position_index = PositionIndex()
+        self.block_bits = BlockBits()
+        self.denotation_cache = DenotationCache()
+        self.bitset_cache = DenotationCache()
+        self.bound = {}
+        self.update(blocks)
+
+    def update(self, blocks):
+        """
+        loads a new picture: replaces the blocks (in place, so that references to self.blocks stay valid), removes the
+        denotations and guesses computed for the previous picture and indexes the new blocks
+        :param blocks: iterable of all Block objects of the picture
+        """
+        self.blocks[:] = blocks
+        self.clear_guesses()
+        self.denotation_cache.clear()
+        self.bitset_cache.clear()
+        self.attribute_index.update(self.blocks)
+        self.position_index.update(self.blocks)
+        self.block_bits.update(self.blocks)
+
+    def update_guess(self, blocks):
+        """
+        updates the guesses by adding the referenced blocks and additionally recursively backtracking all matching
+        blocks in order to get the complete list of guessed blocks
+        the guessed blocks of a BlockSet are added to guess_mask without creating the Block objects
+        :param blocks: BlockList or BlockSet, i.e. the referenced blocks
+        :return: True
+        """
+        if isinstance(blocks, BlockSet):
+            self.guess_mask |= bitset_guesses(blocks)
+        else:
+            self.guesses.update(guesses_of(blocks))
+        return True
+
+    def take_guesses(self, bitset=False):
+        """
+        :param bitset: True for a grammar using the bitset backend
+        :return: the guessed blocks of the formula that was evaluated, the guesses are reset for the next one; a set of
+                Block objects, or for the bitset backend a BlockSet of their bitmask, which is only converted into
+                Block objects when it is iterated, e.g. to mark the guess in the picture
+        """
+        bits = self.block_bits
+        if bitset:
+            guesses = BlockSet(self.guess_mask | bits.mask(self.guesses), bits)
+        else:
+            guesses = set(self.guesses)
+            guesses.update(bits.blocks_of(self.guess_mask))
+        self.clear_guesses()
+        return guesses
+
+    def clear_guesses(self):
+        """
+        removes the guessed blocks of the formula that was evaluated
+        """
+        self.guesses.clear()
+        self.guess_mask = 0
+
+    def cache(self, bitset=False):
+        """
+        :param bitset: True for a grammar using the bitset backend
+        :return: the DenotationCache for the grammar
+        """
+        return self.bitset_cache if bitset else self.denotation_cache
+
+    def names(self, functions):
+        """
+        binds the functions of a grammar to this context: every entry of the functions mapping is called with the
+        context and returns the function used in the logical forms
+        the bound names are only created the first time a functions mapping is used with the context
+        :param functions: dictionary mapping the names used in the logical forms to functions of an EvaluationContext
+        :return: dictionary mapping the names used in the logical forms to their values, including allblocks
+        """
+        bound = self.bound.get(id(functions))
+        if bound is None:
+            names = {name: function(self) for name, function in functions.items()}
+            names['allblocks'] = self.blocks
+            # the functions mapping is kept so that its id is not reused while the context exists
+            bound = (functions, names)
+            self.bound[id(functions)] = bound
+        return bound[1]
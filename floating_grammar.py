@@ -1,6 +1,9 @@
-import sys
-from collections import defaultdict
-from itertools import product
+from collections import defaultdict, deque, Counter
+from heapq import heappush, heappop
+from itertools import product, count
+from math import inf
+import time
+import numpy as np
 from eval_helper import *
 from world import *
 
@@ -17,61 +20,317 @@ all green triangles that are over red squares that are over any circle
 whereas guessed blocks consists of all green triangles, red squares and circles that make this sentence true
 """
 
+# evaluation context of the current picture, used by the grammars if no other context is given,
+# see EvaluationContext in eval_helper.py
+picture_context = EvaluationContext()
 # variable to store all blocks of the current picture
-allblocks = []
+allblocks = picture_context.blocks
 # variable to store the guessed blocks for an input utterance
-guessed_blocks = set()
+guessed_blocks = picture_context.guesses
+# denotations of the subformulas w.r.t. the current picture, see DenotationCache in eval_helper.py
+denotation_cache = picture_context.denotation_cache
+# the same for the grammars using the bitset backend, see bitset_backend in eval_helper.py
+bitset_cache = picture_context.bitset_cache
 # only needed when running this script separately for demo or testing purpose
 all_blocks_grid = []
 
-def create_all_blocks(picture):
+def create_all_blocks(picture, context=picture_context):
     """
-    updates the allblocks by resetting and then adding all blocks of the Picture object
+    loads all blocks of the Picture object into the evaluation context, by default the one of the current picture
+    (i.e. allblocks)
+    the denotations computed for the previous picture are removed from the denotation caches, the blocks are indexed
+    by colour and shape and the bitmasks of the blocks are computed (see EvaluationContext in eval_helper.py)
     :param picture: a Picture object as defined in BlockPictureGenerator.py
+    :param context: EvaluationContext
     :return: None
     """
-    allblocks.clear()
+    blocks = []
     grid = picture.grid
     for row in grid:
         for b in row:
             if b:
-                allblocks.append(b)
+                blocks.append(b)
+    context.update(blocks)
     return None
 
-def update_guess(blocks):
-    """
-    updates the guessed_blocks variable by adding the referenced blocks and additionally
-    recursively backtracking all matching blocks in order to get the complete list of guessed blocks
-    :param blocks: list of Block objects, i.e. the referenced blocks
-    :return: True
-    """
-    guesses = set()
-    stack = blocks.copy()
-
-    while stack != []:
-        b = stack.pop()
-        guesses.add(b)
-        stack.extend(b.back_track)
-        b.back_track = []
-    for b in allblocks:
-        b.back_track = []
-    guessed_blocks.update(set(guesses))
-    return True
-
 
 def create_lex_rules():
     """
     creates the crude lexical rules for learning from scratch
-    :return: set containing all lists from gold lexicon with the (category, logical form) tuples
+    :return: sorted list of the (category, logical form, weight) tuples from the gold lexicon, sorted so that the
+            order in which the parser builds the lexical ParseItems does not depend on the hash seed
     """
     crude_rules = set()
     for key, value in gold_lexicon_basic.items():
         for entry in value:
             crude_rules.add((entry[0], entry[1], 0))
 
-    return list(crude_rules)
+    return sorted(crude_rules)
+
+
+class CrudeRules:
+    """
+    Registry of the crude lexical rules for learning from scratch that are allowed at the current level of the game.
+    A new word only gets the crude rules of the categories that can occur in the descriptions of the current level
+    (see level_categories), e.g. a word in level 1 gets no POS or CONJ rules. When the level rises, the entries of the
+    words that are already in the lexicon are widened by the rules of the categories that are allowed from then on.
+    """
+
+    def __init__(self, level=1):
+        """
+        :param level: int, the current level
+        """
+        self.level = level
+        # the crude lexical rules by category, see create_lex_rules
+        self.by_category = defaultdict(list)
+        for entry in create_lex_rules():
+            self.by_category[entry[0]].append(entry)
+
+
+    def categories(self, level=None):
+        """
+        :param level: int, by default the current level
+        :return: set of the categories of the crude rules that are allowed at the level, categories that are not in
+                level_categories are allowed from the first level on
+        """
+        if level is None:
+            level = self.level
+        later = {categorie for first_level, categories in level_categories.items() if first_level > level
+                 for categorie in categories}
+        return set(self.by_category) - later
+
+
+    def rules(self, level=None):
+        """
+        :param level: int, by default the current level
+        :return: list of the crude rules that are allowed at the level
+        """
+        return [entry for categorie in sorted(self.categories(level)) for entry in self.by_category[categorie]]
+
+
+    def add_words(self, gram, words):
+        """
+        maps each word that is not in the lexicon of the grammar yet to all crude rules that are allowed at the current
+        level
+        :param gram: Grammar object, whose lexicon is changed with Grammar.add_word
+        :param words: list of strings
+        :return: list of pairs (word, rule) of the added lexical rules
+        """
+        added = []
+        for word in words:
+            if word not in gram.entries:
+                entries = self.rules()
+                gram.add_word(word, entries)
+                added.extend((word, entry) for entry in entries)
+        return added
+
+
+    def update_level(self, gram, level):
+        """
+        sets the current level, if the level rises the entries of all words in the lexicon of the grammar are widened by
+        the crude rules of the categories that are allowed from the new level on
+        :param gram: Grammar object, whose lexicon is changed with Grammar.add_word
+        :param level: int, the new level
+        :return: list of pairs (word, rule) of the added lexical rules
+        """
+        entries = [entry for categorie in sorted(self.categories(level) - self.categories())
+                   for entry in self.by_category[categorie]]
+        self.level = level
+        added = []
+        if entries:
+            for word in list(gram.entries):
+                gram.add_word(word, entries)
+                added.extend((word, entry) for entry in entries)
+        return added
+
+
+
+
+class FormulaTable:
+    """
+    Interned logical forms and lexical components of the ParseItems of a Grammar
+    Each distinct formula gets an int id. A formula is stored as the string of its lexical rule or as the pair of the ids
+    of its subformulas (the one that is applied and its argument), so combining two formulas does not build a new
+    string, the string representation is only built when it is needed
+    Each distinct pair of a word and a lexical rule (a component of a ParseItem) gets an int id as well and so does
+    each distinct set of these ids, so all ParseItems built from the same components share one frozenset
+    Together with the parse chart, in which there is only one ParseItem per category, size, formula and set of
+    components, this stores the derivations as a graph in which identical subderivations are the same object
+    The formulas do not depend on the utterance and are shared by all parses of a Grammar, whereas the components
+    contain the words of the utterance, so each parse gets its own FormulaTable for them (see Grammar.fill_chart) that
+    is released together with the ParseItems of the parse
+    """
+    def __init__(self, shared=None):
+        """
+        :param shared: FormulaTable whose formulas are shared with this one or None, the components are never shared
+        """
+        if shared is None:
+            # lexical rule string or pair of subformula ids -> id
+            self.formula_ids = {}
+            # id -> lexical rule string or pair of subformula ids
+            self.formulas = []
+            # id -> string representation, only for the formulas whose string was needed
+            self.strings = {}
+        else:
+            self.formula_ids = shared.formula_ids
+            self.formulas = shared.formulas
+            self.strings = shared.strings
+        # pair of word and lexical rule -> id
+        self.component_ids = {}
+        # id -> pair of word and lexical rule
+        self.components = []
+        # frozenset of component ids -> id
+        self.component_set_ids = {}
+        # id -> frozenset of component ids
+        self.component_sets = []
+
+    def intern(self, formula):
+        """
+        :param formula: string of a lexical rule or pair of the ids of the applied subformula and its argument
+        :return: the id of the formula
+        """
+        f_id = self.formula_ids.get(formula)
+        if f_id is None:
+            f_id = len(self.formulas)
+            self.formula_ids[formula] = f_id
+            self.formulas.append(formula)
+        return f_id
+
+    def string(self, f_id):
+        """
+        :param f_id: id of a formula
+        :return: the string representation of the formula
+        """
+        str_form = self.strings.get(f_id)
+        if str_form is None:
+            formula = self.formulas[f_id]
+            if isinstance(formula, str):
+                str_form = formula
+            else:
+                str_form = self.string(formula[0]) + "(" + self.string(formula[1]) + ")"
+            self.strings[f_id] = str_form
+        return str_form
+
+    def component(self, word, function):
+        """
+        :param word: string, word from the utterance or "" for formulas out of the air
+        :param function: string, the lexical rule paired with the word
+        :return: the id of the pair
+        """
+        c_id = self.component_ids.get((word, function))
+        if c_id is None:
+            c_id = len(self.components)
+            self.component_ids[word, function] = c_id
+            self.components.append((word, function))
+        return c_id
+
+    def component_set(self, component_ids):
+        """
+        :param component_ids: frozenset of component ids
+        :return: the id of the set
+        """
+        s_id = self.component_set_ids.get(component_ids)
+        if s_id is None:
+            s_id = len(self.component_sets)
+            self.component_set_ids[component_ids] = s_id
+            self.component_sets.append(component_ids)
+        return s_id
+
+
+class WeightTable:
+    """
+    Weights of the lexical rules of a Grammar as a matrix with one row per word and one column per logical form
+    Words and logical forms are interned to int ids like in FormulaTable, the matrix grows when new ones are added.
+    The cell of a pair of a word and a logical form that is not a lexical rule of the word is nan, so adding to it
+    keeps it nan and it is never below a threshold.
+    The weights learned for the features of the lexical rules (pairs of word and logical form, see phi_sem) are added
+    to all cells in one vectorized update and the rules whose weight fell to a threshold are found without looping
+    over the lexicon.
+    """
+    def __init__(self):
+        # word -> row
+        self.word_ids = {}
+        # row -> word
+        self.words = []
+        # logical form -> column
+        self.rule_ids = {}
+        # column -> logical form
+        self.rules = []
+        # the weights, only the first len(self.words) rows and len(self.rules) columns are used
+        self.matrix = np.full((8, 8), np.nan)
+
+    def intern(self, word, function):
+        """
+        :param word: string
+        :param function: string, a logical form
+        :return: pair of the row of the word and the column of the logical form, the matrix is enlarged if necessary
+        """
+        row = self.word_ids.get(word)
+        if row is None:
+            row = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        column = self.rule_ids.get(function)
+        if column is None:
+            column = self.rule_ids[function] = len(self.rules)
+            self.rules.append(function)
+        n_rows, n_columns = self.matrix.shape
+        if row >= n_rows or column >= n_columns:
+            matrix = np.full((max(n_rows, 2 * row), max(n_columns, 2 * column)), np.nan)
+            matrix[:n_rows, :n_columns] = self.matrix
+            self.matrix = matrix
+        return row, column
+
+    def cell(self, word, function):
+        """
+        :return: pair of the row of the word and the column of the logical form or None if one of them is unknown
+        """
+        row = self.word_ids.get(word)
+        column = self.rule_ids.get(function)
+        if row is None or column is None:
+            return None
+        return row, column
 
+    def get(self, word, function):
+        """
+        :return: the weight of the lexical rule, nan if the logical form is not a lexical rule of the word
+        """
+        cell = self.cell(word, function)
+        return np.nan if cell is None else float(self.matrix[cell])
+
+    def weights(self, word, functions):
+        """
+        :param word: string, a known word
+        :param functions: list of logical forms that are known
+        :return: list of the weights (floats) of the lexical rules of the word with these logical forms
+        """
+        return self.matrix[self.word_ids[word], [self.rule_ids[function] for function in functions]].tolist()
+
+    def set(self, word, function, weight):
+        """
+        sets the weight of a lexical rule, a nan weight removes it
+        """
+        cell = self.intern(word, function)
+        self.matrix[cell] = weight
+
+    def add(self, weights):
+        """
+        adds learned weights to the weights of the lexical rules in one vectorized update
+        :param weights: dictionary mapping features to weights as returned by the learner, only the features that are
+                    pairs of a known word and a known logical form are used
+        """
+        cells = [(self.cell(*f), value) for f, value in weights.items() if len(f) == 2]
+        cells = [(cell, value) for cell, value in cells if cell is not None]
+        if cells:
+            rows, columns = zip(*(cell for cell, value in cells))
+            np.add.at(self.matrix, (list(rows), list(columns)), [value for cell, value in cells])
 
+    def below(self, threshold):
+        """
+        :param threshold: float
+        :return: list of pairs (word, logical form) of the lexical rules whose weight is at most the threshold
+        """
+        rows, columns = np.nonzero(self.matrix[:len(self.words), :len(self.rules)] <= threshold)
+        return [(self.words[row], self.rules[column]) for row, column in zip(rows.tolist(), columns.tolist())]
 
 
 class ParseItem:
@@ -81,31 +340,115 @@ class ParseItem:
     s: int, size of the formula (= out of how many subformulas it is built)
     semantic: Truth value of the formula when evaluated with respect to a picture; None if the formula is not a complete
                 formula, i.e. if c is not "V"
-    components: set of pairs of words from the utterance and the lexical rule paired with it by the parser
-    formular: string representation of the formula
+    component_set: int, id of the set of the ids of the pairs of words from the utterance and the lexical rule paired
+                with it by the parser, see FormulaTable
+    formula: int, id of the formula, see FormulaTable
+    table: the FormulaTable of the parse that built the ParseItem
     guessed_blocks: list of Block Objects, list of the guessed blocks when formular is evaluate w.r.t a given picture
-                    the list is empty if formula is not complete yet, i.e. if c is not "V"
+                    the list is empty if formula is not complete yet, i.e. if c is not "V"; a BlockSet for a Grammar
+                    using the bitset backend, see EvaluationContext.take_guesses
     summed_weights: float, sum of the weights of the subformulas
+    coverage: int, encodes how often each word of the utterance is included in the formula, see Grammar.word_coverage
+    weight_bound: float, sum of the highest weights (at least 0) of the included words in the lexicon, i.e. an upper
+                  bound for summed_weights used in best-first mode, see Grammar.gen_best
+    pruned: True if the ParseItem was removed from the parse chart in beam mode or merged with an equivalent ParseItem,
+            False otherwise
+    key: pair of formula and component_set, two ParseItems with the same key represent the same formula built from the
+         same components
+    order: int, position of the ParseItem among all ParseItems added to the parse chart, breaks ties in beam mode
+    component_ids, components and formular give the set of component ids, the pairs of words and lexical rules and the
+    string representation of the formula
     """
-    def __init__(self, categorie, length, semantic, components, str_form, guesses, weight, rem, incl):
+    __slots__ = ('c', 's', 'semantic', 'component_set', 'formula', 'table', 'guessed_blocks', 'summed_weights',
+                 'coverage', 'weight_bound', 'pruned', 'key', 'order')
+
+    def __init__(self, categorie, length, semantic, component_set, formula, table, guesses, weight, coverage,
+                 weight_bound=0):
         """
         :param categorie: string, category of the formula
         :param length: int, size of the formula
         :param semantic: Truth value of the formula or None
-        :param components: set of pairs of words from the utterance and the lexical rule paired with it by the parser
-        :param str_form: string representation of the formula
+        :param component_set: int, id of the set of the ids of the pairs of words and lexical rules
+        :param formula: int, id of the formula
+        :param table: FormulaTable in which the ids are stored
         :param guesses: list of Block Objects or empty list
         :param weight: float, weight of the formula
+        :param coverage: int, encoding of the included words
+        :param weight_bound: float, upper bound for the weight of the formula
         """
         self.c = categorie
         self.s = length
         self.semantic = semantic
-        self.components = components
-        self.formular = str_form
+        self.component_set = component_set
+        self.formula = formula
+        self.table = table
         self.guessed_blocks = guesses
         self.summed_weights = weight
-        self.included_words = incl
-        self.remaining_words = rem
+        self.coverage = coverage
+        self.weight_bound = weight_bound
+        self.pruned = False
+        self.key = (formula, component_set)
+        self.order = 0
+
+    @property
+    def formular(self):
+        """string representation of the formula"""
+        return self.table.string(self.formula)
+
+    @property
+    def component_ids(self):
+        """frozenset of the ids of the pairs of words and lexical rules, see FormulaTable"""
+        return self.table.component_sets[self.component_set]
+
+    @property
+    def components(self):
+        """frozenset of pairs of words from the utterance and the lexical rule paired with it by the parser"""
+        return frozenset(self.table.components[c_id] for c_id in self.component_ids)
+
+
+class ItemIndex:
+    """
+    Collection of ParseItems in which ParseItems with the same key (i.e. the same formula and the same components)
+    are only included once
+    Checking whether an equivalent ParseItem is already included is a single dictionary lookup instead of
+    a comparison with every ParseItem in the collection
+    """
+    def __init__(self):
+        self.items = {}
+
+    def add(self, p_item):
+        """
+        adds a ParseItem unless a ParseItem with the same key is already included
+        :param p_item: a ParseItem object
+        :return: True if p_item was added, False if an equivalent ParseItem was already included
+        """
+        if p_item.key in self.items:
+            return False
+        self.items[p_item.key] = p_item
+        return True
+
+    def remove(self, p_item):
+        """
+        removes a ParseItem
+        :param p_item: a ParseItem object that is included
+        """
+        del self.items[p_item.key]
+
+    def __contains__(self, p_item):
+        return p_item.key in self.items
+
+    def contains_key(self, key):
+        """
+        :param key: pair of formula and component_set
+        :return: True if a ParseItem with this key is included, False otherwise
+        """
+        return key in self.items
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+    def __len__(self):
+        return len(self.items)
 
 
 
@@ -113,209 +456,697 @@ class ParseItem:
 """
 The framework below is taken from Potts & Liang
 We defined our own lexicon, rules and  functions and extended the main function demonstrating our grammar framework
-The Grammar class was taken from Potts & Liang and we kept the sem function but replaced methods for the actual parsing
-with an implementation of the floating parser instead of the basic cky parser
+The Grammar class was taken from Potts & Liang and we kept the sem function (only adding compile so that each logical
+form is compiled once) but replaced methods for the actual parsing with an implementation of the floating parser
+instead of the basic cky parser
 """
 
 class Grammar:
 
+    # collection used for the cells of the parse chart and for the results, see ItemIndex
+    item_index = ItemIndex
+
     def __init__(self, lexicon, rules, functions):
         """For examples of these arguments, see below."""
-        self.lexicon = lexicon
         self.functions = functions
         self.rules = rules
+        # the rules indexed by the categories of the children, see index_rules
+        self.right_partners, self.left_partners = self.index_rules(rules)
+        # the grammar owns the lexicon, which is changed with add_word, update_weight and delete_rule
+        # so that the grammar can be kept for a whole session instead of being created again for each change
+        # the lexical rules of each word as pairs (category, logical form), their weights are stored in self.weights
+        self.entries = {}
+        # the weights of the lexical rules, see WeightTable
+        self.weights = WeightTable()
+        # number of lexical rules of each category in the lexicon
+        self.lexical_categories = Counter()
+        # minimum number of further leaves each category needs to become part of a formula of category V, see
+        # leaves_to_start, only computed again if the set of the categories in the lexicon changes
+        self.leaves_to_v = self.leaves_to_start(rules, {categorie for categorie, function, weight in out_of_air})
+        # number of changes of the lexicon
+        self.version = 0
+        for word, entries in lexicon.items():
+            self.add_word(word, entries)
+        self.version = 0
+        # namespace in which the logical forms are evaluated (together with self.functions bound to an
+        # EvaluationContext)
+        self.namespace = globals()
+        # True for the bitset backend, whose denotations are stored separately as they are BlockSets
+        self.bitset = isinstance(functions, BitsetFunctions)
+        # interned formulas of the ParseItems, shared by the FormulaTables of all parses, see FormulaTable
+        self.table = FormulaTable()
+        # compiled logical forms by id, see compile
+        self.compiled = {}
+        # number of ParseItems that were pruned in beam mode during the last call of gen
+        self.n_pruned = 0
+        # numbers the ParseItems in the order in which they are added to the chart, see add_to_chart
+        self.insertions = count()
+        # number of ParseItems that were merged with an equivalent ParseItem during the last call of gen
+        self.n_merged = 0
+        # number of lexical rules that were deferred by the picture filter during the last call of gen
+        self.n_deferred = 0
+        # True if the last call of gen_stream was stopped because of its time_limit or max_items
+        self.cut_off = False
+        # in best-first mode the highest possible weight of the formulas that are not built yet, see fill_chart
+        self.upper_bound = inf
+
+
+    @property
+    def lexicon(self):
+        """
+        :return: dictionary mapping each word to the list of its lexical rules (category, logical form, weight), built
+                from self.entries and self.weights, changing it does not change the grammar
+        """
+        return {word: self.lexical_rules(word, entries) for word, entries in self.entries.items()}
+
+
+    def lexical_rules(self, word, entries):
+        """
+        :param word: string, a word in the lexicon
+        :param entries: list of pairs (category, logical form) of lexical rules of the word
+        :return: list of the lexical rules (category, logical form, weight)
+        """
+        weights = self.weights.weights(word, [function for categorie, function in entries])
+        return [(categorie, function, weight) for (categorie, function), weight in zip(entries, weights)]
+
+
+    def add_word(self, word, entries):
+        """
+        adds lexical rules to the lexicon: a new word gets these rules, the entry of a known word is extended by them
+        :param word: string
+        :param entries: list of lexical rules (category, logical form, weight), the weight is 0 if it is left out
+        """
+        categories = set(self.lexical_categories)
+        word_entries = self.entries.setdefault(word, [])
+        for entry in entries:
+            word_entries.append((entry[0], entry[1]))
+            self.weights.set(word, entry[1], entry[2] if len(entry) > 2 else 0)
+        self.lexical_categories.update(entry[0] for entry in entries)
+        self.version += 1
+        self.update_categories(categories)
+
+
+    def update_weight(self, word, function, weight):
+        """
+        sets the weight of the lexical rules of a word with the given logical form
+        :param word: string, a word in the lexicon
+        :param function: string, the logical form of the lexical rule
+        :param weight: the new weight
+        """
+        if not np.isnan(self.weights.get(word, function)):
+            self.weights.set(word, function, weight)
+        self.version += 1
+
+
+    def add_weights(self, weights):
+        """
+        adds the weights learned for the lexical rules to their weights, see WeightTable.add
+        :param weights: dictionary mapping features to weights as returned by the learner
+        """
+        self.weights.add(weights)
+        self.version += 1
+
 
+    def delete_below(self, threshold):
+        """
+        removes all lexical rules whose weight is at most the threshold from the lexicon
+        :param threshold: float
+        :return: list of pairs (word, logical form) of the removed lexical rules
+        """
+        deleted = self.weights.below(threshold)
+        for word, function in deleted:
+            self.delete_rule(word, function)
+        return deleted
 
 
-    def gen(self,s):
+    def delete_rule(self, word, function):
+        """
+        removes the lexical rules of a word with the given logical form from the lexicon
+        :param word: string, a word in the lexicon
+        :param function: string, the logical form of the lexical rule
+        :return: list of the removed lexical rules
+        """
+        categories = set(self.lexical_categories)
+        entries = self.entries[word]
+        removed = self.lexical_rules(word, [entry for entry in entries if entry[1] == function])
+        entries[:] = [entry for entry in entries if entry[1] != function]
+        if removed:
+            self.weights.set(word, function, np.nan)
+        self.lexical_categories.subtract(entry[0] for entry in removed)
+        # only keep the categories that still occur in the lexicon
+        self.lexical_categories = +self.lexical_categories
+        self.version += 1
+        self.update_categories(categories)
+        return removed
+
+
+    def update_categories(self, categories):
+        """
+        computes leaves_to_v again if the set of the categories in the lexicon changed
+        the formulas and compiled logical forms do not depend on the lexicon and are kept
+        :param categories: set of the categories in the lexicon before it was changed
+        """
+        if categories != set(self.lexical_categories):
+            self.leaves_to_v = self.leaves_to_start(self.rules, set(self.lexical_categories)
+                                                    | {categorie for categorie, function, weight in out_of_air})
+
+
+    def gen(self, s, beam=None, merge_equivalent=False, context=None, prefilter=False):
         """
         The Floating Parser
         :param s: string, the input utterance
+        :param beam: int, if given only the beam ParseItems with the highest summed_weights are kept in each cell
+                    (category, size) of the parse chart, the number of pruned ParseItems is stored in self.n_pruned;
+                    None (default) builds up all possible formulas; a ValueError is raised if beam is less than 1
+        :param merge_equivalent: if True, ParseItems of the categories in block_categories are evaluated w.r.t. the
+                    current picture and of all ParseItems with the same category and size that are built from the same
+                    words and have the same denotation only the one with the highest summed_weights is kept, the
+                    number of merged ParseItems is stored in self.n_merged
+        :param context: EvaluationContext the formulas are evaluated in, by default the one of the current picture
+        :param prefilter: if True, the lexical rules that are empty on the current picture are deferred (see
+                    picture_filter) and only used if no true formula can be built without them, the number of
+                    deferred lexical rules is stored in self.n_deferred; no rule is deferred if a word of the utterance
+                    can be a disjunction, so the results are the same as without prefilter
         :return: a list of all ParseItems that correspond to all possible logical formulas of category "V" that can be
                 generated for the input utterance based on the grammar
         """
-        # tokens of the input utterance
+        self.check_beam(beam)
+        if context is None:
+            context = picture_context
         words = s.split()
+        lexicons = [self.entries]
+        self.n_deferred = 0
+        if prefilter:
+            lexicon = self.picture_filter(words, context)
+            self.n_deferred = sum(len(self.entries[word]) - len(lexicon[word]) for word in lexicon)
+            if self.n_deferred:
+                lexicons.insert(0, lexicon)
+
+        for lexicon in lexicons:
+            # initialize parse chart, chart[c][s] is the cell with the ParseItems of category c and size s
+            # each cell only keeps one ParseItem per formula and components
+            chart = defaultdict(lambda: defaultdict(self.item_index))
+            # build up all possible formulas, see fill_chart
+            for item in self.fill_chart(words, chart, beam, merge_equivalent, context=context, lexicon=lexicon):
+                pass
+
+            results = []
+            # keep track that ParseItems that represent the same formula built from the same components only occur once in the result
+            included_items = self.item_index()
+            # out of all the formulas the parse built up, only return those that are complete, i.e. category = "V" and
+            # can be evaluated
+            for s in chart['V']:
+                for item in chart['V'][s]:
+                    # evaluate the formula
+                    self.evaluate(item, context)
+                    # if average of weights should be computed for the total weight of a formula include the line below
+                    # item.summed_weights = item.summed_weights / item.s
+                    if item.semantic and included_items.add(item):
+                        results.append(item)
+            # the deferred lexical rules are only needed if no true formula was found without them
+            if results:
+                break
+
+        return results
+
+
+    def picture_filter(self, words, context=None):
+        """
+        evaluates the lexical rules of the words w.r.t. the picture of the context before parsing
+        a formula of a category in block_categories that denotes no block, or of a category in filter_categories that
+        selects no block of the picture, makes every formula it is part of denote no block, so exist is false for it
+        such a lexical rule can only become part of a true formula of category "V" as the false side of a disjunction,
+        so it is left out of the lexicon the parser starts with, unless one of the words has a lexical rule in
+        disjunctions: then no lexical rule is left out, so that no true formula gets lost
+        :param words: list of strings, the tokens of the input utterance
+        :param context: see gen
+        :return: dictionary mapping each word to its lexical rules (category, logical form) that are not empty on the
+                picture (all its lexical rules if a word can be a disjunction)
+        """
+        if context is None:
+            context = picture_context
+        if any(function in disjunctions for word in words for categorie, function in self.entries[word]):
+            return {word: self.entries[word] for word in words}
+        table = self.table
+        lexicon = {}
+        for word in words:
+            if word in lexicon:
+                continue
+            entries = []
+            for entry in self.entries[word]:
+                categorie, function = entry
+                if categorie in block_categories:
+                    denotation = self.compile(table.intern(function))(context)
+                elif categorie in filter_categories:
+                    # applied to all blocks the filter selects every block it can select from any list of blocks
+                    f_id = table.intern((table.intern(function), table.intern('allblocks')))
+                    denotation = self.compile(f_id)(context)
+                else:
+                    denotation = None
+                if denotation is None or len(denotation):
+                    entries.append(entry)
+            lexicon[word] = entries
+        return lexicon
+
+
+    def gen_stream(self, s, beam=None, merge_equivalent=False, time_limit=None, max_items=None, context=None):
+        """
+        The Floating Parser as a generator that yields the complete formulas as soon as they are built, so that a first
+        guess can be shown before the whole parse chart is built up
+        in beam mode a ParseItem may be yielded that gen would not return, because it is pruned from the parse chart
+        later on
+        :param s: string, the input utterance
+        :param beam: see gen
+        :param merge_equivalent: see gen
+        :param time_limit: float, if given the parser stops after this many seconds; the time is only checked when a
+                    ParseItem is added to the parse chart, so the parser can run longer while no ParseItem is added
+        :param max_items: int, if given the parser stops after this many ParseItems were added to the parse chart
+        if the parser was stopped because of time_limit or max_items, self.cut_off is set to True
+        :param context: see gen
+        :return: generator yielding the ParseItems of category "V" that are true w.r.t. the picture, each formula built
+                from the same components only once
+        """
+        self.check_beam(beam)
+        if context is None:
+            context = picture_context
+        start = time.perf_counter()
+        self.cut_off = False
+        chart = defaultdict(lambda: defaultdict(self.item_index))
+        included_items = self.item_index()
+        n_items = 0
+        for item in self.fill_chart(s.split(), chart, beam, merge_equivalent, context=context):
+            n_items += 1
+            if item.c == 'V':
+                self.evaluate(item, context)
+                if item.semantic and included_items.add(item):
+                    yield item
+            if (time_limit is not None and time.perf_counter() - start > time_limit) or \
+                    (max_items is not None and n_items >= max_items):
+                self.cut_off = True
+                return
+
+
+    def gen_best(self, s, k=1, merge_equivalent=False, context=None):
+        """
+        The Floating Parser in best-first mode: finds the k guesses with the highest weights without building up all
+        possible formulas
+        The formulas are built in the order of the highest weight a complete formula built from them could have.
+        As soon as the k best guesses found so far all have a weight of at least this bound, no formula that is not
+        built yet can lead to a better guess and the parser stops.
+        :param s: string, the input utterance
+        :param k: int, number of guesses
+        :param merge_equivalent: see gen
+        :param context: see gen
+        :return: pair of a dictionary and a list like grouping, the dictionary maps the guessed blocks to the true
+                ParseItems found for them (sorted by summed_weights, the first one has the highest weight of all
+                ParseItems for this guess), the list contains the (at most) k best guesses sorted by their weight
+        """
+        if context is None:
+            context = picture_context
+        chart = defaultdict(lambda: defaultdict(self.item_index))
+        included_items = self.item_index()
+        groups = defaultdict(list)
+        # highest weight of each guess found so far and the k-th highest of these weights
+        best_guesses = {}
+        kth_weight = -inf
+        for item in self.fill_chart(s.split(), chart, merge_equivalent=merge_equivalent, best_first=True,
+                                    context=context):
+            if item.c == 'V':
+                self.evaluate(item, context)
+                if item.semantic and included_items.add(item):
+                    guess = guess_key(item.guessed_blocks)
+                    groups[guess].append(item)
+                    best_guesses[guess] = max(best_guesses.get(guess, -inf), item.summed_weights)
+                    if len(best_guesses) >= k:
+                        kth_weight = sorted(best_guesses.values(), reverse=True)[k-1]
+            # stop as soon as the k best guesses are certain
+            if kth_weight >= self.upper_bound:
+                break
+
+        for grouped_items in groups.values():
+            grouped_items.sort(key=lambda p_item: p_item.summed_weights, reverse=True)
+        sorted_guesses = sorted(best_guesses, key=lambda guess: best_guesses[guess], reverse=True)[:k]
+        return groups, sorted_guesses
+
+
+    def evaluate(self, p_item, context):
+        """
+        evaluates the formula of a ParseItem w.r.t. the picture of the context and stores its truth value and guessed
+        blocks
+        :param p_item: ParseItem of category "V"
+        :param context: EvaluationContext
+        """
+        p_item.semantic = self.sem(p_item, context)
+        # store the guessed blocks that were created during evaluation and reset for next formula
+        p_item.guessed_blocks = context.take_guesses(self.bitset)
+
+
+    def fill_chart(self, words, chart, beam=None, merge_equivalent=False, best_first=False, context=None,
+                   lexicon=None):
+        """
+        builds up the formulas for the input tokens bottom-up and adds them to the parse chart
+        :param words: list of strings, the tokens of the input utterance
+        :param chart: the parse chart, chart[c][s] is the cell with the ParseItems of category c and size s
+        :param beam: see gen
+        :param merge_equivalent: see gen
+        :param best_first: if True, the ParseItem with the highest possible weight of a complete formula built from it
+                    is taken from the agenda first instead of the one that was put on the agenda first, and
+                    self.upper_bound is set to this weight each time, see gen_best
+        :param context: EvaluationContext the ParseItems are evaluated in for merge_equivalent
+        :param lexicon: the lexical rules (category, logical form) of the words, by default self.entries, see
+                    picture_filter
+        :return: generator yielding each ParseItem directly after it was added to the parse chart
+        """
+        if lexicon is None:
+            lexicon = self.entries
+        # the lexical rules of the words with their weights
+        lexicon = {word: self.lexical_rules(word, lexicon[word]) for word in set(words)}
         # maximum length until which parser should build up formulas
         # set to length of input + 2 to account for potentially missing color and exist that has to be inserted "out of the air"
         maxlen = len(words)+4
-        # initialize parse chart
-        chart = defaultdict(set)
         # agenda with all ParseItems that the parser has not tried to combine to any entry in the parse chart so far
-        agenda = []
+        # a ParseItem is only put on the agenda the first time it is added to the chart, so that equivalent ParseItems
+        # that are built again from different subformulas are not combined a second time
+        # in best-first mode the agenda is a heap ordered by the highest possible weight of a complete formula built
+        # from a ParseItem, i.e. its summed_weights plus the highest weights of the words it does not include yet
+        # this bound can only decrease when ParseItems are combined, so no formula built after a ParseItem was taken
+        # from the agenda can have a higher weight than this ParseItem's bound
+        if best_first:
+            agenda = []
+            order = count()
+            def push(p_item):
+                heappush(agenda, (p_item.weight_bound - p_item.summed_weights, next(order), p_item))
+            def pop():
+                return heappop(agenda)[2]
+        else:
+            agenda = deque()
+            push = agenda.append
+            pop = agenda.popleft
+        self.upper_bound = inf
+        self.n_pruned = 0
+        self.n_merged = 0
+        # numbers the ParseItems in the order in which they are added to the chart
+        self.insertions = count()
+        # in merge_equivalent mode the ParseItems in the chart indexed by category, size, included words and denotation
+        equivalents = {} if merge_equivalent else None
+        # encoding of the included words of the ParseItems
+        word_units, limit, guards = self.word_coverage(words)
+        # the components of this parse are interned in a table of their own, only the formulas are shared
+        table = FormulaTable(self.table)
+        intern = table.intern
+        component_set = table.component_set
+        component_sets = table.component_sets
+        # highest weight of each word in the lexicon and the highest possible weight of any formula
+        best_weights = {word: max([0] + [weight for categorie, function, weight in lexicon[word]]) for word in words}
+        total_bound = sum(best_weights[word] for word in words)
 
         # construct predicates according to tokens in the utterance
         # constructs a ParseItem for each input token and each lexical rule matching it according to the lexicon
         for word in words:
-            for categorie, function, weight in self.lexicon[word]:
+            for categorie, function, weight in lexicon[word]:
                 semantic = None
-                remaining = words.copy()
-                remaining.remove(word)
-                item = ParseItem(categorie, 1, semantic, {(word, function)}, function, guessed_blocks, weight, remaining, [word])
-                chart[categorie, 1].add(item)
-                agenda.append(item)
+                # lexical ParseItems that cannot become part of a complete formula are not built at all
+                if 1 + self.leaves_to_v.get(categorie, inf) > maxlen:
+                    continue
+                item = ParseItem(categorie, 1, semantic, component_set(frozenset([table.component(word, function)])),
+                                 table.intern(function), table, frozenset(), weight, word_units[word],
+                                 best_weights[word])
+                if self.add_to_chart(chart, item, beam, equivalents, context):
+                    push(item)
+                    yield item
 
         # constructs predicates out of the air (i.e. with no corresponding token in the input utterance)
-        for (categorie, function, weight) in out_of_air:
-            remaining = words.copy()
-            item = ParseItem(categorie, 1, None, {("", function)}, function, guessed_blocks, 0, remaining, [])
-            agenda.append(item)
+        # sorted so that the order of the ParseItems does not depend on the hash seed
+        for (categorie, function, weight) in sorted(out_of_air):
+            if 1 + self.leaves_to_v.get(categorie, inf) > maxlen:
+                continue
+            item = ParseItem(categorie, 1, None, component_set(frozenset([table.component("", function)])),
+                             table.intern(function), table, frozenset(), 0, 0)
+            push(item)
 
         # construct longer formulas bottom-up by combining the shorter ones based on the rules of the grammar:
-        maxlen_currently = 1
         # build up all possible formulas until no formula not exceeding the max. length is left
         while agenda:
             # take a not yet considered formula from the agenda
-            item = agenda.pop(0)
+            item = pop()
+            # ParseItems that were pruned from the chart in beam mode after they were put on the agenda are not used
+            if item.pruned:
+                continue
+            if best_first:
+                self.upper_bound = total_bound - item.weight_bound + item.summed_weights
             s1 = item.s
             c1 = item.c
-            components1 = item.components
-            new_items = set()
+            components1 = component_sets[item.component_set]
+            formula1 = item.formula
+            coverage1 = item.coverage
+            new_items = []
 
             # try if this formula can be combined with any other formula in the parse chart to yield a
-            # new, longer formula in line with the grammar
-            for c2, s2 in chart:
-                s_new = s1+s2
-                if maxlen_currently < s_new:
-                    maxlen_currently = s_new
-
-                if (c2,c1) in self.rules:
-                     c_new = self.rules[c2, c1]
-                     # for each possible combination create a new ParseItem object for the resulting combined formula
-                     for item2 in chart[c2, s2]:
-                         new_incl, new_rem = self.check_preconditions(item, item2, words)
-                         if not new_incl:
-                             continue
-
-                         semantic_new = None
-                         components_new = components1.union(item2.components)
-                         function_new = item2.formular + "(" + item.formular + ")"
-                         weight_new = item.summed_weights + item2.summed_weights
-                         item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, guessed_blocks,
-                                              weight_new, new_rem, new_incl)
-                         # only add new ParseItem if its formula does not exceed the max size
-                         if s_new <= maxlen:
-                            # check that new ParseItem is not already on the agenda
-                            if not self.check_member(agenda, item_new):
-                                agenda.append(item_new)
-                         
-                            new_items.add(item_new)
-
-                if (c1,c2) in self.rules:
-                     c_new = self.rules[c1, c2]
-                     # for each possible combination create a new ParseItem object for the resulting combined formula
-                     for item2 in chart[c2, s2]:
-                         new_incl, new_rem = self.check_preconditions(item, item2, words)
-                         if not new_incl:
-                             continue
-                         semantic_new = None
-                         components_new = components1.union(item2.components)
-                         function_new = item.formular + "(" + item2.formular + ")"
-                         weight_new = item.summed_weights + item2.summed_weights
-                         item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, guessed_blocks,
-                                              weight_new, new_rem, new_incl)
-                         # only add new ParseItem if its formula does not exceed the max size
-                         if s_new <= maxlen:
-                            # check that new ParseItem is not already on the agenda
-                            if not self.check_member(agenda, item_new):
-                                agenda.append(item_new)
-                         
-                            new_items.add(item_new)
-
-            # add the newly built ParseItems to the chart
-            for new_item in new_items:
-                # check that only ParseItems that are not already in the chart are added
-                chart_list = list(chart[new_item.c, new_item.s].copy())
-                if not self.check_member(chart_list, new_item):
-                    chart[new_item.c,new_item.s].add(new_item)
-
-
-        results = []
-        # keep track that ParseItems that represent the same formula built from the same components only occur once in the result
-        included_items = []
-        # out of all the formulas the parse built up, only return those that are complete, i.e. category = "V" and can
-        # be evaluated
-        for (c,s) in chart:
-            if c == 'V':
-                for item in chart[c,s]:
-                    # evaluate the formula
-                    item.semantic = self.sem(item)
-                    # store the guessed_blocks that were created during evaluation and reset for next formula
-                    item.guessed_blocks = guessed_blocks.copy()
-                    guessed_blocks.clear()
-                    # if average of weights should be computed for the total weight of a formula include the line below
-                    # item.summed_weights = item.summed_weights / item.s
-                    if self.check_member(included_items, item):
+            # new, longer formula in line with the grammar, only the cells of the chart with a category that
+            # can be combined with c1 according to the rules are considered
+            # first with this formula as the left child, i.e. applied to the other formula
+            for c2, c_new in self.right_partners.get(c1, ()):
+                # only build new ParseItems if they can still become part of a formula of category V that does not
+                # exceed the max size, i.e. together with the leaves their category needs at least to get to V
+                budget = maxlen - self.leaves_to_v.get(c_new, inf)
+                for s2, cell in chart[c2].items():
+                    s_new = s1+s2
+                    if s_new > budget:
                         continue
-                    else:
-                        if item.semantic:
-                            results.append(item)
-                            included_items.append(item)
+                    # cell of the new ParseItems, no new ParseItem is created if it is already in there
+                    # (in beam mode it could be pruned from the cell before the new ParseItems are added, so they are
+                    # always created)
+                    cell_new = chart[c_new].get(s_new) if beam is None else None
+                    # for each possible combination create a new ParseItem object for the resulting combined formula
+                    for item2 in cell:
+                        # both formulas together must not include any word more often than the utterance
+                        # (and at least one word), see word_coverage
+                        coverage_new = coverage1 + item2.coverage
+                        if not coverage_new or ((limit - coverage_new) & guards) != guards:
+                            continue
+                        semantic_new = None
+                        components_new = component_set(components1 | component_sets[item2.component_set])
+                        function_new = intern((formula1, item2.formula))
+                        if cell_new is not None and cell_new.contains_key((function_new, components_new)):
+                            continue
+                        weight_new = item.summed_weights + item2.summed_weights
+                        item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, table,
+                                             frozenset(), weight_new, coverage_new,
+                                             item.weight_bound + item2.weight_bound)
+                        new_items.append(item_new)
+
+            # then with this formula as the right child, i.e. the other formula is applied to it
+            for c2, c_new in self.left_partners.get(c1, ()):
+                budget = maxlen - self.leaves_to_v.get(c_new, inf)
+                for s2, cell in chart[c2].items():
+                    s_new = s1+s2
+                    if s_new > budget:
+                        continue
+                    cell_new = chart[c_new].get(s_new) if beam is None else None
+                    for item2 in cell:
+                        coverage_new = coverage1 + item2.coverage
+                        if not coverage_new or ((limit - coverage_new) & guards) != guards:
+                            continue
+                        semantic_new = None
+                        components_new = component_set(components1 | component_sets[item2.component_set])
+                        function_new = intern((item2.formula, formula1))
+                        if cell_new is not None and cell_new.contains_key((function_new, components_new)):
+                            continue
+                        weight_new = item.summed_weights + item2.summed_weights
+                        item_new = ParseItem(c_new, s_new, semantic_new, components_new, function_new, table,
+                                             frozenset(), weight_new, coverage_new,
+                                             item.weight_bound + item2.weight_bound)
+                        new_items.append(item_new)
+
+            # add the newly built ParseItems to the chart and the agenda
+            # unless the same formula from the same components is already in the chart
+            for new_item in new_items:
+                if self.add_to_chart(chart, new_item, beam, equivalents, context):
+                    push(new_item)
+                    yield new_item
+        # all formulas are built
+        self.upper_bound = -inf
 
-        return results
+
+    def check_beam(self, beam):
+        """
+        :param beam: see gen
+        :raise ValueError: if beam is given but less than 1, as a cell with no ParseItems cannot keep any
+        """
+        if beam is not None and beam < 1:
+            raise ValueError("beam must be at least 1 or None, got {}".format(beam))
 
 
-    def check_member(self, p_item_list, p_item):
+    def add_to_chart(self, chart, p_item, beam=None, equivalents=None, context=None):
         """
-        checks for an ParseItem and a list of ParseItems whether there is already a ParseItem with the same formular and the same components in the list
-        :param p_item_list: a list of ParseItem objects
+        adds a ParseItem to its cell in the parse chart unless an equivalent ParseItem is already in that cell
+        if equivalents is given, a ParseItem that has the same denotation as a ParseItem in the same cell and is built
+        from the same words is merged with it, i.e. only the one with the higher summed_weights is kept
+        ParseItems with the same denotation and the same words can be combined with the same ParseItems and result in
+        formulas with the same denotations, so no guess gets lost by merging them
+        in beam mode a full cell only keeps the beam ParseItems with the highest summed_weights, i.e. either the new
+        ParseItem or the ParseItem with the lowest weight in the cell is pruned; among ParseItems with the same weight the
+        one that was added last is pruned, so the new ParseItem is pruned if it is not better than the worst one
+        the cells of the lexical ParseItems (size 1) are never pruned as this would remove words from the utterance
+        :param chart: the parse chart
         :param p_item: a ParseItem object
-        :return: True or False
-        """
-        for pi in p_item_list:
-            if pi.formular == p_item.formular and pi.components == p_item.components:
-                return True
-        return False
-
-
-    def check_preconditions(self,pi_1, pi_2, words):
-        """
-        :param pi_1:
-        :param pi_2:
-        :param words:
-        """
-        flag1 = False
-        flag2 = False
-
-        if len(pi_1.included_words) <= len(pi_2.remaining_words):
-            flag1 = True
-            temp_list = pi_2.remaining_words.copy()
-            for w in pi_1.included_words:
-                try:
-                    temp_list.remove(w)
-                except:
-                    flag1 = False
-
-        if len(pi_2.included_words) <= len(pi_1.remaining_words):
-            flag2 = True
-            temp_list = pi_1.remaining_words.copy()
-            for w in pi_2.included_words:
-                try:
-                    temp_list.remove(w)
-                except:
-                    flag2 = False
-
-        if flag1 and flag2:
-            new_included = pi_1.included_words + pi_2.included_words
-            new_remaining = words.copy()
-            for new in new_included:
-                new_remaining.remove(new)
-            return new_included, new_remaining
-
-        else:
-            return None, None
+        :param beam: int, max number of ParseItems per cell or None if no ParseItems should be pruned
+        :param equivalents: dictionary mapping category, size, included words and denotation to the ParseItem in the
+                    chart or None if no ParseItems should be merged
+        :param context: EvaluationContext the denotations are computed in if equivalents is given
+        :return: True if p_item was added to the chart, False otherwise
+        """
+        cell = chart[p_item.c][p_item.s]
+        if p_item in cell:
+            return False
+        if equivalents is not None and p_item.c in block_categories:
+            equivalence = (p_item.c, p_item.s, p_item.coverage, denotation_key(self.sem(p_item, context)))
+            equivalent = equivalents.get(equivalence)
+            if equivalent is not None and not equivalent.pruned:
+                self.n_merged += 1
+                if p_item.summed_weights <= equivalent.summed_weights:
+                    return False
+                cell.remove(equivalent)
+                equivalent.pruned = True
+            equivalents[equivalence] = p_item
+        if beam is not None and p_item.s > 1 and len(cell) >= beam:
+            self.n_pruned += 1
+            worst = min(cell, key=lambda pi: (pi.summed_weights, -pi.order))
+            if p_item.summed_weights <= worst.summed_weights:
+                p_item.pruned = True
+                return False
+            cell.remove(worst)
+            worst.pruned = True
+        p_item.order = next(self.insertions)
+        return cell.add(p_item)
+
+
+    def index_rules(self, rules):
+        """
+        indexes the rules by the categories of the children, so that the parser only has to look at the cells of the
+        parse chart with categories that can be combined with a given category
+        :param rules: list of triples (left child, right child, parent)
+        :return: pair of dictionaries: the first maps the left child to a list of pairs (right child, parent), the
+                second maps the right child to a list of pairs (left child, parent)
+        """
+        right_partners = defaultdict(list)
+        left_partners = defaultdict(list)
+        for left, right, mother in rules:
+            right_partners[left].append((right, mother))
+            left_partners[right].append((left, mother))
+        return dict(right_partners), dict(left_partners)
 
 
-    def sem(self, lf):
+    def leaves_to_start(self, rules, lexical_categories, start='V'):
+        """
+        computes for each category the minimum number of leaves (lexical or out of the air formulas) that have to be
+        combined with a formula of this category to get a formula of the start category
+        a ParseItem of category c and size s can only become part of a complete formula of size <= maxlen if
+        s + leaves_to_start[c] <= maxlen, all other ParseItems do not need to be built
+        :param rules: list of triples (left child, right child, parent)
+        :param lexical_categories: set of the categories of the lexical and out of the air formulas
+        :param start: the start category
+        :return: dictionary mapping each category from which the start category can be reached to the minimum number
+                of further leaves, categories that can never become part of a complete formula are not included
+        """
+        # minimum number of leaves a formula of each category is built of
+        min_leaves = {c: 1 for c in lexical_categories}
+        changed = True
+        while changed:
+            changed = False
+            for left, right, mother in rules:
+                if left in min_leaves and right in min_leaves:
+                    size = min_leaves[left] + min_leaves[right]
+                    if size < min_leaves.get(mother, inf):
+                        min_leaves[mother] = size
+                        changed = True
+
+        # minimum number of leaves of the siblings on the way from each category to the start category
+        to_start = {start: 0}
+        changed = True
+        while changed:
+            changed = False
+            for left, right, mother in rules:
+                if mother not in to_start:
+                    continue
+                for child, sibling in ((left, right), (right, left)):
+                    if sibling in min_leaves:
+                        size = to_start[mother] + min_leaves[sibling]
+                        if size < to_start.get(child, inf):
+                            to_start[child] = size
+                            changed = True
+        return to_start
+
+
+    def word_coverage(self, words):
+        """
+        prepares the encoding of the words included in a ParseItem as a single integer (its coverage)
+        each distinct word of the utterance gets its own bit field that counts how often the word is included, so the
+        coverage of two combined ParseItems is the sum of their coverages
+        above the largest possible sum of two counts each field has a guard bit: two ParseItems can only be combined if
+        no word is included more often than it occurs in the utterance, i.e. if subtracting the sum of their coverages
+        from limit leaves all guard bits set
+        for utterances without repeated words this is the same as checking that two bitmasks do not overlap
+        :param words: list of tokens of the input utterance
+        :return: triple of a dictionary mapping each word to the coverage of a single occurrence of it, limit (the number
+                of occurrences of each word with all guard bits set) and guards (only the guard bits set)
+        """
+        word_units = {}
+        limit = 0
+        guards = 0
+        offset = 0
+        for word in words:
+            if word in word_units:
+                continue
+            count = words.count(word)
+            width = (2 * count).bit_length()
+            word_units[word] = 1 << offset
+            guard = 1 << (offset + width)
+            limit |= (count << offset) | guard
+            guards |= guard
+            offset += width + 1
+        return word_units, limit, guards
+
+
+    def compile(self, f_id):
+        """
+        compiles a logical form only once so that evaluating it again does not require parsing its string
+        representation again; a logical form built from two subformulas is compiled into a function that applies the
+        compiled subformulas to each other
+        the denotations are looked up in the denotation cache of the EvaluationContext so that subformulas that are
+        shared by several formulas are only computed once per picture
+        the logical forms are only compiled when they are evaluated for the first time
+        :param f_id: id of the logical form in self.table
+        :return: function that evaluates the logical form in the EvaluationContext it is called with
+        """
+        compiled = self.compiled.get(f_id)
+        if compiled is None:
+            formula = self.table.formulas[f_id]
+            if isinstance(formula, str):
+                code = compile(formula, "<logical form>", "eval")
+                namespace, functions = self.namespace, self.functions
+                evaluate = lambda context: eval(code, namespace, context.names(functions))
+            else:
+                function, argument = self.compile(formula[0]), self.compile(formula[1])
+                evaluate = lambda context: function(context)(argument(context))
+            str_form = self.table.string(f_id)
+            if self.bitset:
+                compiled = lambda context: context.bitset_cache.denotation(str_form, evaluate, context)
+            else:
+                compiled = lambda context: context.denotation_cache.denotation(str_form, evaluate, context)
+            self.compiled[f_id] = compiled
+        return compiled
+
+
+    def sem(self, lf, context=None):
         """Interpret, as Python code, the root of a logical form
         generated by this grammar."""
-        # Import all of the user's functions into the namespace to
-        # help with the interpretation of the logical forms.
-        grammar = sys.modules[__name__]
-        for key, val in list(self.functions.items()):
-            setattr(grammar, key, val)
-        # Interpret semantics.
-        return eval(lf.formular)
+        # The user's functions are looked up in self.functions bound to the
+        # evaluation context (by default the one of the current picture), the
+        # compiled logical form is reused for every evaluation of the same formula.
+        if context is None:
+            context = picture_context
+        return self.compile(lf.formula)(context)
 
 
 # The lexica for our pictures
@@ -324,13 +1155,13 @@ class Grammar:
 gold_lexicon_basic = {
     'form':[('B', 'block_filter([], allblocks)', 1)],
     'forms':[('B', 'block_filter([], allblocks)')],
-    'square': [('B', 'block_filter([lambda b: b.shape=="rectangle"], allblocks)', 1)],
-    'squares': [('B', 'block_filter([lambda b: b.shape=="rectangle"], allblocks)', 1)],
-    'triangle': [('B', 'block_filter([(lambda b: b.shape == "triangle")], allblocks)', 1)],
-    'triangles': [('B', 'block_filter([(lambda b: b.shape == "triangle")], allblocks)', 1)],
-    'circle': [('B', 'block_filter([(lambda b: b.shape == "circle")], allblocks)', 1)],
-    'circles': [('B', 'block_filter([(lambda b: b.shape == "circle")], allblocks)', 1)],
-    'a':[('N','range(1,17)', 1)],
+    'square': [('B', 'block_filter([has_shape("rectangle")], allblocks)', 1)],
+    'squares': [('B', 'block_filter([has_shape("rectangle")], allblocks)', 1)],
+    'triangle': [('B', 'block_filter([has_shape("triangle")], allblocks)', 1)],
+    'triangles': [('B', 'block_filter([has_shape("triangle")], allblocks)', 1)],
+    'circle': [('B', 'block_filter([has_shape("circle")], allblocks)', 1)],
+    'circles': [('B', 'block_filter([has_shape("circle")], allblocks)', 1)],
+    'a':[('N','range(1, len(allblocks) + 1)', 1)],
     'one':[('N','[1]', 1)],
     'two':[('N','[2]', 1)],
     'three':[('N','[3]', 1)],
@@ -356,46 +1187,76 @@ out_of_air = {
     ('E', 'exist', 1)
 }
 
-# The binarized rule dictionary for our pictures, start symbol is V
-# each entry has a pair of categories as key and a category as value, ('B', 'C') : 'A'
+# categories of the formulas that denote a list of blocks
+block_categories = {'B', 'BC', 'BS'}
+
+# categories of the formulas that are applied to a list of blocks and denote a subset of it
+filter_categories = {'C'}
+
+# logical forms that are true if one of their arguments is true, so a formula that is false can be part of a true
+# formula, see picture_filter
+disjunctions = {'oder', 'xoder'}
+
+# the categories of the crude lexical rules that are allowed from each level of the game on, see CrudeRules
+# level 1: shapes and numbers, level 2: colours, level 3: relations and conjunctions
+level_categories = {
+    1: {'B', 'N'},
+    2: {'C'},
+    3: {'POS', 'CONJ'}
+}
+
+# The binarized rule set for our pictures, start symbol is V
+# each entry is a triple of categories ('B', 'C', 'A')
 # where A is the parent category, B the left child and C the right child
 # order of the child categories defines the order in which the logical representations are applied
 # e.g. The first rule corresponds to: V -> EN  BC  and specifies that EN is applied to BC: EN(BC)
-rules = {
- ('EN', 'BC'): 'V',
- ('EN', 'BS'): 'V',
- ('CONJ', 'V'): 'CONJ_1',
- ('CONJ_1', 'V'): 'V',
- ('E', 'N'): 'EN',
- ('C', 'B'): 'BC',
- ('POS', 'N'): 'POS_N',
- ('POS_N', 'BC'): 'POS_NB',
- ('POS_NB', 'BC'): 'BC',
- ('POS_NB', 'BC'): 'BS'
-
-}
+# the same pair of children can have several parent categories
+rules = [
+ ('EN', 'BC', 'V'),
+ ('EN', 'BS', 'V'),
+ ('CONJ', 'V', 'CONJ_1'),
+ ('CONJ_1', 'V', 'V'),
+ ('E', 'N', 'EN'),
+ ('C', 'B', 'BC'),
+ ('POS', 'N', 'POS_N'),
+ ('POS_N', 'BC', 'POS_NB'),
+ ('POS_NB', 'BC', 'BC'),
+ ('POS_NB', 'BC', 'BS')
+]
 
 # The functions that are used to interpret our logical forms with eval.
 # They are imported into the namespace Grammar.sem to achieve that.
+# Each entry is called with the EvaluationContext the logical forms are evaluated in and returns the function.
 functions = {
-    'exist': (lambda n: (lambda b: update_guess(b) and len(b) in n)),
-    'und': (lambda v1: (lambda v2: v1 and v2)),
-    'oder': (lambda v1: (lambda v2: v1 or v2)),
-    'xoder': (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1))),
-
-    'blue': (lambda x: block_filter([(lambda b:b.colour == "blue")], x)),
-    'red': (lambda x: block_filter([(lambda b:b.colour == "red")], x)),
-    'green': (lambda x: block_filter([(lambda b:b.colour == "green")], x)),
-    'yellow':(lambda x: block_filter([(lambda b:b.colour == "yellow")], x)),
-    'anycol':(lambda x: block_filter([], x)),
-
-    'under': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "u")))),
-    'over': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "o")))),
-    'next': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "n")))),
-    'left': (lambda n: (lambda x: (lambda y:position_test(y, x, n, "l")))),
-    'right': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "r"))))
+    'exist': (lambda context: (lambda n: (lambda b: context.update_guess(b) and len(b) in n))),
+    'und': (lambda context: (lambda v1: (lambda v2: v1 and v2))),
+    'oder': (lambda context: (lambda v1: (lambda v2: v1 or v2))),
+    'xoder': (lambda context: (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1)))),
+
+    'block_filter': (lambda context: (lambda conditions, blocks:
+                                      block_filter(conditions, blocks, context.attribute_index))),
+    'blue': (lambda context: (lambda x: block_filter([has_colour("blue")], x, context.attribute_index))),
+    'red': (lambda context: (lambda x: block_filter([has_colour("red")], x, context.attribute_index))),
+    'green': (lambda context: (lambda x: block_filter([has_colour("green")], x, context.attribute_index))),
+    'yellow': (lambda context: (lambda x: block_filter([has_colour("yellow")], x, context.attribute_index))),
+    'anycol': (lambda context: (lambda x: block_filter([], x))),
+
+    'under': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "u", context.position_index))))),
+    'over': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "o", context.position_index))))),
+    'next': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "n", context.position_index))))),
+    'left': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "l", context.position_index))))),
+    'right': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "r", context.position_index)))))
 }
 
+# The same functions for evaluating the logical forms with the bitset backend, i.e. the blocks are represented as
+# bitmasks instead of lists of Block objects, e.g. Grammar(gold_lexicon, rules, bitset_functions)
+bitset_functions = bitset_backend(functions)
+
 
 
 def grouping(lfs):
@@ -403,7 +1264,7 @@ def grouping(lfs):
     max_weights = []
     for lf in lfs:
         if lf.semantic:
-            groups[frozenset(lf.guessed_blocks)].append(lf)
+            groups[guess_key(lf.guessed_blocks)].append(lf)
     #print(groups)
     for grouped_items in groups.values():
         grouped_items.sort(key=lambda p_item: p_item.summed_weights, reverse=True)
@@ -428,7 +1289,7 @@ if __name__ == "__main__":
         for blo in row:
             if blo:
                 allblocks2.append(blo)
-    allblocks = allblocks2
+    picture_context.update(allblocks2)
 
     #lfs = gram.gen("a red triangle and a green square")
     #lfs = gram.gen("is one red triangle over a blue triangle")
@@ -449,4 +1310,5 @@ if __name__ == "__main__":
         for block in guess:
             print(block.y, block.x)
         print("new_guess")
+    print("denotation cache: {} hits, {} misses".format(denotation_cache.hits, denotation_cache.misses))
 
@@ -14,52 +14,43 @@ all green triangles that are over red squares that are over any circle
 whereas guessed blocks consists of all green triangles, red squares and circles that make this sentence true
 """
 
-import sys
 from collections import defaultdict
-from itertools import product
+from itertools import product, islice
 from eval_helper import *
 
+# evaluation context of the current picture, used by the grammars if no other context is given,
+# see EvaluationContext in eval_helper.py
+picture_context = EvaluationContext()
 # variable to store all blocks of the current picture
-allblocks = []
+allblocks = picture_context.blocks
 # variable to store the guessed blocks for an input utterance
-guessed_blocks = set()
+guessed_blocks = picture_context.guesses
+# denotations of the subformulas w.r.t. the current picture, see DenotationCache in eval_helper.py
+denotation_cache = picture_context.denotation_cache
+# the same for the grammars using the bitset backend, see bitset_backend in eval_helper.py
+bitset_cache = picture_context.bitset_cache
 # only needed when running this script separately for demo or testing purpose
 all_blocks_grid = []
 
-def create_all_blocks(picture):
+def create_all_blocks(picture, context=picture_context):
     """
-    updates the allblocks by resetting and then adding all blocks of the Picture object
+    loads all blocks of the Picture object into the evaluation context, by default the one of the current picture
+    (i.e. allblocks)
+    the denotations computed for the previous picture are removed from the denotation caches, the blocks are indexed
+    by colour and shape and the bitmasks of the blocks are computed (see EvaluationContext in eval_helper.py)
     :param picture: a Picture object as defined in BlockPictureGenerator.py
+    :param context: EvaluationContext
     :return: None
     """
-    allblocks.clear()
+    blocks = []
     grid = picture.grid
     for row in grid:
         for b in row:
             if b:
-                allblocks.append(b)            
+                blocks.append(b)
+    context.update(blocks)
     return None
 
-def update_guess(blocks):
-    """
-    updates the guessed_blocks variable by adding the referenced blocks and additionally
-    recursively backtracking all matching blocks in order to get the complete list of guessed blocks
-    :param blocks: list of Block objects, i.e. the referenced blocks
-    :return: True
-    """
-    guesses = set()
-    stack = blocks.copy()
-
-    while stack != []:
-        b = stack.pop()
-        guesses.add(b)
-        stack.extend(b.back_track)
-        b.back_track = []
-    for b in allblocks:
-        b.back_track = []
-    guessed_blocks.update(set(guesses))
-    return True
-
 
 def create_lex_rules():
     """
@@ -81,16 +72,18 @@ class ParseItem:
     s: int, size of the formula (= out of how many subformulas it is built)
     semantic: Truth value of the formula when evaluated with respect to a picture; None if the formula is not a complete
                 formula, i.e. if c is not "V"
-    components: set of pairs of words from the utterance and the lexical rule paired with it by the parser
+    components: frozenset of pairs of words from the utterance and the lexical rule paired with it by the parser
     formular: string representation of the formula
     guessed_blocks: list of Block Objects, list of the guessed blocks when formular is evaluate w.r.t a given picture
                     the list is empty if formula is not complete yet, i.e. if c is not "V"
     """
+    __slots__ = ('c', 's', 'semantic', 'components', 'formular', 'guessed_blocks')
+
     def __init__(self,categorie,length,semantic,components,str_form,guesses):
         self.c = categorie
         self.s = length
         self.semantic = semantic
-        self.components = components
+        self.components = frozenset(components)
         self.formular = str_form
         self.guessed_blocks = guesses
 
@@ -100,7 +93,10 @@ The framework below is taken from Potts & Liang
 We defined our own lexicon, rules and  functions and extended the main function demonstrating our grammar framework
 The Grammar class was taken from Potts & Liang and we adapted the CKY parser by adding backpointers and added the 
 methods needed to use the backpointers and recursively build the tree
-allcombos and sem were not changed by us
+the backpointers were later changed into a packed parse forest from which the trees are only built when needed and
+over which the trees are evaluated bottom-up
+sem was only changed so that each logical form is compiled once (see compile), allcombos now combines categories and
+looks them up in an index of the rules (see index_rules)
 """
 
 class Grammar:
@@ -110,38 +106,73 @@ class Grammar:
         self.lexicon = lexicon
         self.rules = rules
         self.functions = functions
+        # the rules indexed by the pair of child categories, see index_rules
+        self.rule_index = self.index_rules(rules)
+        # packed parse forest of the last parsed utterance, see gen
         self.backpointers = defaultdict(list)
-
-    def recursive_treebuild(self, current):
+        # number of parse trees of the nodes of the parse forest, see count_trees
+        self.tree_counts = {}
+        # logical forms and denotations of the trees of the nodes of the parse forest, see evaluate_node
+        self.node_denotations = {}
+        # namespace in which the logical forms are evaluated (together with self.functions bound to an
+        # EvaluationContext)
+        self.namespace = globals()
+        # True for the bitset backend, whose denotations are stored separately as they are BlockSets
+        self.bitset = isinstance(functions, BitsetFunctions)
+        # compiled logical forms, see compile
+        self.compiled = {}
+
+    def iter_trees(self, current):
         """
-        recursively builds up the tree parse tree based on self.backpointers
+        lazily builds up the parse trees based on the packed parse forest self.backpointers, i.e. the next tree is
+        only built when it is needed
         :param current: triple consisting of (Nonterminal, start_index, end_index) for which the trees with the
                         root Nonterminal that covers the input from start_index to end_index should be build
-        :return: list of all possible trees with root Nonterminal covering start_index to end_index
+        :return: generator yielding all possible trees with root Nonterminal covering start_index to end_index, the
+                root of each tree is labeled with a pair of the Nonterminal and the logical form of the tree
         """
         current_label = current[0]
         current_start = current[1]
         current_end = current[2]
-        sub_trees = []
         if current_end - current_start == 1:
-            leaf = self.backpointers[current]
-            tree = [current_label, leaf]
-            sub_trees.append(tree)
+            for semantic, word in self.backpointers[current]:
+                yield [(current_label, semantic), [word]]
         else:
-            possible_children = self.backpointers[current]
-            for pointer in possible_children:
-                child1 = pointer[0]
-                child2 = pointer[1]
-                k = pointer[2]
-                left_subtrees = self.recursive_treebuild((child1, current_start, k))
-                right_subtrees = self.recursive_treebuild((child2, k, current_end))
+            for child1, child2, k, app_order in self.backpointers[current]:
+                for left in self.iter_trees((child1, current_start, k)):
+                    for right in self.iter_trees((child2, k, current_end)):
+                        sem = [left[0][1], right[0][1]]
+                        parts = (sem[app_order[0]], sem[app_order[1]])
+                        formular = "{}({})".format(*parts)
+                        self.compile(formular, parts)
+                        yield [(current_label, formular), [left, right]]
 
-                for left in left_subtrees:
-                    for right in right_subtrees:
-                        tree = [current_label, [left, right]]
-                        sub_trees.append(tree)
 
-        return sub_trees
+    def recursive_treebuild(self, current):
+        """
+        builds up all parse trees based on self.backpointers, see iter_trees
+        :param current: triple consisting of (Nonterminal, start_index, end_index)
+        :return: list of all possible trees with root Nonterminal covering start_index to end_index
+        """
+        return list(self.iter_trees(current))
+
+
+    def count_trees(self, current):
+        """
+        counts the parse trees in the packed parse forest without building them
+        :param current: triple consisting of (Nonterminal, start_index, end_index)
+        :return: int, number of trees with root Nonterminal covering start_index to end_index
+        """
+        count = self.tree_counts.get(current)
+        if count is None:
+            if current[2] - current[1] == 1:
+                count = len(self.backpointers[current])
+            else:
+                count = 0
+                for child1, child2, k, app_order in self.backpointers[current]:
+                    count += self.count_trees((child1, current[1], k)) * self.count_trees((child2, k, current[2]))
+            self.tree_counts[current] = count
+        return count
 
 
     def compute_parse_trees(self, n):
@@ -151,71 +182,165 @@ class Grammar:
         :param n: int length of the string that should be covered by the tree + 1
         :return: list of all parse trees
         """
-        parse_trees = []
-        for l, x, y in self.backpointers:
-            if l[0] == "V" and x == 0 and y == n:
-                parse_trees += self.recursive_treebuild((l, x, y))
-        return parse_trees
+        return self.recursive_treebuild(("V", 0, n))
 
 
-    def gen(self, s):
+    def gen(self, s, max_trees=None, context=None):
         """CYK parsing, but we just keep the full derivations. The input
-        s should be a string that can be parsed with this grammar."""
+        s should be a string that can be parsed with this grammar.
+        The chart is a packed parse forest: for each span there is one node per category, self.backpointers maps
+        each node to all the ways it can be built (the lexical logical forms for single words or the pairs of child
+        categories, the split point and the order of application), so the number of nodes does not grow with the
+        number of parse trees.
+        All parse trees are evaluated bottom-up over the forest (see evaluate_node), so the denotation of a subtree
+        is computed once and reused by every tree that contains it.
+        If max_trees is given, only the first max_trees parse trees are built from the forest and evaluated.
+        The trees are evaluated in context (an EvaluationContext), by default in the one of the current picture."""
+        if context is None:
+            context = picture_context
         words = s.split()
         n = len(words) + 1
         trace = defaultdict(set)
         self.backpointers = defaultdict(list)
+        self.tree_counts = {}
+        self.node_denotations = {}
 
         for i in range(1, n):
             word = words[i - 1]
             for syntax, semantic in self.lexicon[word]:
-                trace[(i - 1, i)].add((syntax, semantic))
-                self.backpointers[((syntax, semantic), i - 1, i)].append(word)
+                trace[(i - 1, i)].add(syntax)
+                self.compile(semantic)
+                if (semantic, word) not in self.backpointers[(syntax, i - 1, i)]:
+                    self.backpointers[(syntax, i - 1, i)].append((semantic, word))
 
         for j in range(2, n):
             for i in range(j - 1, -1, -1):
                 for k in range(i + 1, j):
                     for c1, c2 in product(trace[(i, k)], trace[(k, j)]):
-                        for lfnode in self.allcombos(c1, c2):
-                            trace[(i, j)].add(lfnode)
-                            self.backpointers[(lfnode, i, j)].append((c1, c2, k))
+                        for mother, app_order in self.allcombos(c1, c2):
+                            trace[(i, j)].add(mother)
+                            self.backpointers[(mother, i, j)].append((c1, c2, k, app_order))
         # Return only full parses, from the upper right of the chart:
         results = []
-        parse_trees = self.compute_parse_trees(n-1)
-        for lf in parse_trees:
+        if max_trees is None:
+            context.clear_guesses()
+            for formular, semantic, guesses in self.evaluate_node(("V", 0, n - 1), context):
+                results.append(ParseItem("V", n, semantic, (), formular, set(guesses)))
+            return results
+
+        for lf in islice(self.iter_trees(("V", 0, n - 1)), max_trees):
             category = lf[0][0]
             formular = lf[0][1]
             l = n
-            p_item = ParseItem(category, n, None, set(), formular, None)
-            p_item.semantic = self.sem(p_item)
-            p_item.guessed_blocks = guessed_blocks.copy()
-            guessed_blocks.clear()
+            p_item = ParseItem(category, n, None, (), formular, None)
+            p_item.semantic = self.sem(p_item, context)
+            p_item.guessed_blocks = context.take_guesses()
             results.append(p_item)
             
         return results
         #return self.compute_parse_trees(n - 1)
 
+    def evaluate_node(self, current, context):
+        """
+        computes the logical forms and denotations of all trees of a node of the packed parse forest bottom-up: the
+        denotation of a tree is computed by applying the denotations of its subtrees, which are computed only once for
+        each node and reused by all trees containing them
+        the guessed blocks of a tree are the ones of its subtrees and the ones added to the guesses of the context when
+        applying them to each other (i.e. by exist)
+        :param current: triple consisting of (Nonterminal, start_index, end_index)
+        :param context: EvaluationContext the trees are evaluated in
+        :return: list of triples (logical form, denotation, guessed blocks) for all trees of the node in the same order
+                as iter_trees
+        """
+        entries = self.node_denotations.get(current)
+        if entries is None:
+            entries = []
+            current_start = current[1]
+            current_end = current[2]
+            if current_end - current_start == 1:
+                for semantic, word in self.backpointers[current]:
+                    denotation = self.compile(semantic)(context)
+                    entries.append((semantic, denotation, self.take_guesses(context)))
+            else:
+                cache = context.cache(self.bitset)
+                for child1, child2, k, app_order in self.backpointers[current]:
+                    for left in self.evaluate_node((child1, current_start, k), context):
+                        for right in self.evaluate_node((child2, k, current_end), context):
+                            sem = [left, right]
+                            function, argument = sem[app_order[0]], sem[app_order[1]]
+                            formular = "{}({})".format(function[0], argument[0])
+                            denotation = cache.denotation(formular, lambda: function[1](argument[1]))
+                            guesses = self.take_guesses(context, left[2] | right[2])
+                            entries.append((formular, denotation, guesses))
+            self.node_denotations[current] = entries
+        return entries
+
+
+    def take_guesses(self, context, guesses=frozenset()):
+        """
+        :param context: EvaluationContext the trees are evaluated in
+        :param guesses: frozenset of the guessed blocks of the subtrees
+        :return: frozenset of these and the guesses of the context, which are reset afterwards
+        """
+        if context.guesses or context.guess_mask:
+            guesses = guesses | context.take_guesses()
+        return guesses
+
+
     def allcombos(self, c1, c2):
-        """Given any two nonterminal node labels, find all the ways
+        """Given any two nonterminal categories, find all the ways
         they can be combined given self.rules."""
-        results = []
-        for left, right, mother, app_order in self.rules:
-            if left == c1[0] and right == c2[0]:
-                sem = [c1[1], c2[1]]
-                results.append((mother, "{}({})".format(
-                    sem[app_order[0]], sem[app_order[1]])))
-        return results
+        return self.rule_index.get((c1, c2), [])
+
+    def index_rules(self, rules):
+        """
+        indexes the rules by the pair of child categories, so that finding the rules for two categories is a single
+        dictionary lookup instead of a loop over all rules
+        :param rules: list of rules [left child, right child, parent, order of application]
+        :return: dictionary mapping pairs (left child, right child) to lists of pairs (parent, order of application)
+        """
+        rule_index = defaultdict(list)
+        for left, right, mother, app_order in rules:
+            rule_index[left, right].append((mother, app_order))
+        return dict(rule_index)
 
-    def sem(self, lf):
+    def compile(self, str_form, parts=None):
+        """
+        compiles a logical form only once so that evaluating it again does not require parsing its string
+        representation again; a logical form built from two subformulas is compiled into a function that applies the
+        compiled subformulas to each other
+        the denotations are looked up in the denotation cache of the EvaluationContext so that subformulas that are
+        shared by several formulas are only computed once per picture
+        :param str_form: string representation of the logical form
+        :param parts: None for lexical logical forms, for combined logical forms the pair of the string representations
+                      of the subformula that is applied and of the subformula it is applied to
+        :return: function that evaluates the logical form in the EvaluationContext it is called with
+        """
+        compiled = self.compiled.get(str_form)
+        if compiled is None:
+            if parts is None:
+                code = compile(str_form, "<logical form>", "eval")
+                namespace, functions = self.namespace, self.functions
+                evaluate = lambda context: eval(code, namespace, context.names(functions))
+            else:
+                function, argument = self.compile(parts[0]), self.compile(parts[1])
+                evaluate = lambda context: function(context)(argument(context))
+            if self.bitset:
+                compiled = lambda context: context.bitset_cache.denotation(str_form, evaluate, context)
+            else:
+                compiled = lambda context: context.denotation_cache.denotation(str_form, evaluate, context)
+            self.compiled[str_form] = compiled
+        return compiled
+
+    def sem(self, lf, context=None):
         """Interpret, as Python code, the root of a logical form
         generated by this grammar."""
-        # Import all of the user's functions into the namespace to
-        # help with the interpretation of the logical forms.
-        grammar = sys.modules[__name__]
-        for key, val in list(self.functions.items()):
-            setattr(grammar, key, val)
-        return eval(lf.formular)
-        #return eval(lf[0][1])  # Interpret just the root node's semantics.
+        # The user's functions are looked up in self.functions bound to the
+        # evaluation context (by default the one of the current picture), the
+        # compiled logical form is reused for every evaluation of the same formula.
+        if context is None:
+            context = picture_context
+        return self.compile(lf.formular)(context)
 
 
 # The lexicon for our pictures
@@ -223,12 +348,12 @@ class Grammar:
 gold_lexicon = {
     'form':[('B', 'block_filter([], allblocks)')],
     'forms':[('B', 'block_filter([], allblocks)')],
-    'square': [('B', 'block_filter([lambda b: b.shape=="rectangle"],allblocks)')],
-    'squares': [('B', 'block_filter([lambda b: b.shape=="rectangle"], allblocks)')],
-    'triangle': [('B', 'block_filter([(lambda b: b.shape == "triangle")], allblocks)')],
-    'triangles': [('B', 'block_filter([(lambda b: b.shape == "triangle")], allblocks)')],
-    'circle': [('B', 'block_filter([(lambda b: b.shape == "circle")], allblocks)')],
-    'circles': [('B', 'block_filter([(lambda b: b.shape == "circle")], allblocks)')],
+    'square': [('B', 'block_filter([has_shape("rectangle")], allblocks)')],
+    'squares': [('B', 'block_filter([has_shape("rectangle")], allblocks)')],
+    'triangle': [('B', 'block_filter([has_shape("triangle")], allblocks)')],
+    'triangles': [('B', 'block_filter([has_shape("triangle")], allblocks)')],
+    'circle': [('B', 'block_filter([has_shape("circle")], allblocks)')],
+    'circles': [('B', 'block_filter([has_shape("circle")], allblocks)')],
     'green': [('C', 'green')],
     'yellow': [('C', 'yellow')],
     'blue': [('C', 'blue')],
@@ -236,7 +361,7 @@ gold_lexicon = {
     'there': [('E', 'identity')],
     'is': [('I', 'exist')],
     'are': [('I', 'exist')],
-    'a':[('N','range(1,17)')],
+    'a':[('N','range(1, len(allblocks) + 1)')],
     'one':[('N','[1]')],
     'two':[('N','[2]')],
     'three':[('N','[3]')],
@@ -279,25 +404,37 @@ rules = [
 
 # The functions that are used to interpret our logical forms with eval.
 # They are imported into the namespace Grammar.sem to achieve that.
+# Each entry is called with the EvaluationContext the logical forms are evaluated in and returns the function.
 functions = {
-    'identity': (lambda x: x),
-    'exist': (lambda n: (lambda b: update_guess(b) and len(b) in n)),
-    'und': (lambda v1: (lambda v2: v1 and v2)),
-    'oder': (lambda v1: (lambda v2: v1 or v2)),
-    'xoder': (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1))),
-
-    'blue': (lambda x: block_filter([(lambda b:b.colour == "blue")], x)),
-    'red': (lambda x: block_filter([(lambda b:b.colour == "red")], x)),
-    'green': (lambda x: block_filter([(lambda b:b.colour == "green")], x)),
-    'yellow':(lambda x: block_filter([(lambda b:b.colour == "yellow")], x)),
-
-    'under': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "u")))),
-    'over': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "o")))),
-    'next': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "n")))),
-    'left': (lambda n: (lambda x: (lambda y:position_test(y, x, n, "l")))),
-    'right': (lambda n: (lambda x: (lambda y: position_test(y, x, n, "r"))))
+    'identity': (lambda context: (lambda x: x)),
+    'exist': (lambda context: (lambda n: (lambda b: context.update_guess(b) and len(b) in n))),
+    'und': (lambda context: (lambda v1: (lambda v2: v1 and v2))),
+    'oder': (lambda context: (lambda v1: (lambda v2: v1 or v2))),
+    'xoder': (lambda context: (lambda v1: (lambda v2: (v1 and not v2) or (v2 and not v1)))),
+
+    'block_filter': (lambda context: (lambda conditions, blocks:
+                                      block_filter(conditions, blocks, context.attribute_index))),
+    'blue': (lambda context: (lambda x: block_filter([has_colour("blue")], x, context.attribute_index))),
+    'red': (lambda context: (lambda x: block_filter([has_colour("red")], x, context.attribute_index))),
+    'green': (lambda context: (lambda x: block_filter([has_colour("green")], x, context.attribute_index))),
+    'yellow': (lambda context: (lambda x: block_filter([has_colour("yellow")], x, context.attribute_index))),
+
+    'under': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "u", context.position_index))))),
+    'over': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "o", context.position_index))))),
+    'next': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "n", context.position_index))))),
+    'left': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "l", context.position_index))))),
+    'right': (lambda context: (lambda n: (lambda x: (lambda y:
+        position_test(y, x, n, "r", context.position_index)))))
 }
 
+# The same functions for evaluating the logical forms with the bitset backend, i.e. the blocks are represented as
+# bitmasks instead of lists of Block objects, e.g. Grammar(gold_lexicon, rules, bitset_functions)
+bitset_functions = bitset_backend(functions)
+
 
 # Main is used for testing the grammar with the test sentences from semdata.py
 # Run the main for a simple demo of our grammar with respect to a
@@ -317,7 +454,7 @@ if __name__ == '__main__':
         for blo in row:
             if blo:
                 allblocks2.append(blo)
-    allblocks = allblocks2
+    picture_context.update(allblocks2)
 
     # parses all test sentences from semdata.py
     # prints the derived logical forms for each test sentence and whether the test sentence is true with respect to the example picture world.png
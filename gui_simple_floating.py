@@ -12,10 +12,12 @@ from cossimforstem import sim_stemm
 from back_and_forth import BackAndForth_Iterator
 
 # inizializing grammar and learning algorithm
-crude_lexicon={}
-crude_rule = create_lex_rules()
+# the grammar is kept for the whole session, its lexicon is changed with add_word, add_weights and delete_below
+# the weights of the lexical rules are stored in gram.weights (see WeightTable in floating_grammar.py)
+gram = Grammar({},rules,functions)
+# crude rules that are allowed at the current level, see CrudeRules in floating_grammar.py
+crude_rules = CrudeRules(level=1)
 threshold = -0.1
-total_scores = defaultdict(lambda:defaultdict(int))
 
 # initializing the windows
 start = sg.Window("Hello!", layout_starting_screen)
@@ -140,24 +142,24 @@ while True:
     if event == "-ENTER-":
         hiding_unhiding(event)
         # stemming in order to find e.g. plural and singular forms and map them to the same lexical entry
-        inpt = sim_stemm(inpt.lower(),list(crude_lexicon))
+        inpt = sim_stemm(inpt.lower(),list(gram.entries))
         
         # for storing in evaluation file
         eval_input = inpt
 
-        # for any new word, map it to all possible rules and set initial weight for each rule to 0
-        for word in inpt.split():
-            if not word in crude_lexicon:
-                crude_lexicon[word]=crude_rule[:]
-                for rule in crude_rule:
-                    total_scores[word][rule]=0
-        gram = Grammar(crude_lexicon,rules,functions)
+        # if the level rose, widen the entries of the known words by the rules that are allowed from now on
+        # for any new word, map it to all rules allowed at the current level
+        # with an initial weight of 0 for each rule
+        crude_rules.update_level(gram, level)
+        crude_rules.add_words(gram, inpt.split())
         print("checkpoint")
         # generate all possible trees given the current rules
         #lfs = BackAndForth_Iterator(gram.gen(inpt))
         #print(lfs)
         # with grouping included so every marking will only appear once, doesnt work though
-        parse = gram.gen(inpt)
+        # the lexical rules that are empty on the current picture are only used if no guess can be found without them
+        # (unless the input can contain a disjunction, see Grammar.picture_filter in floating_grammar.py)
+        parse = gram.gen(inpt, prefilter=True)
         print("parsing done")
 
         groups, sortedguesses = grouping(parse)
@@ -195,42 +197,30 @@ while True:
                     word,rule=w
                     word_rule[word].add(rule)
             for word in word_rule:
-                if word in crude_lexicon:
-                    for categorie,rule,prob in crude_lexicon[word][:]:
+                if word in gram.entries:
+                    for categorie,rule in gram.entries[word][:]:
                         if not rule in word_rule[word]:
-                            crude_lexicon[word].remove((categorie,rule,prob))
+                            gram.delete_rule(word, rule)
                     
                     
         else:
-            for w in weights:
-                if len(w)==2:
-                    word,rule = w
-                    if word == "":
-                        continue
-                    score = weights[w]
-                    total_scores[word][rule]+=score
-                    if total_scores[word][rule]<=threshold :
-                        del total_scores[word][rule]
-                        print("DELETE:",word,rule)
-                        n_deleted_rules += 1
-                        deleted_rules.append((word, rule))
-                        for r in crude_lexicon[word][:]:
-                            if r[1] == rule:
-                                crude_lexicon[word].remove(r)
-                                
-            for word in crude_lexicon:
-                for ruleindex in range(0,len(crude_lexicon[word])):
-                    crude_lexicon[word][ruleindex] = (crude_lexicon[word][ruleindex][0],crude_lexicon[word][ruleindex][1],total_scores[word][crude_lexicon[word][ruleindex][1]])
+            # add the learned weights of the lexical rules to their weights and remove the rules whose weight fell to
+            # the threshold
+            gram.add_weights(weights)
+            for word, rule in gram.delete_below(threshold):
+                print("DELETE:",word,rule)
+                n_deleted_rules += 1
+                deleted_rules.append((word, rule))
                     
         
-        gram = Grammar(crude_lexicon,rules,functions)
         print("\nNew Lexicon:")
-        for word in crude_lexicon:
+        lexicon = gram.lexicon
+        for word in lexicon:
             print("---",word,"---")
-            for rule in crude_lexicon[word]:
+            for rule in lexicon[word]:
                 print(rule)
-            #print(crude_lexicon[word])
-        #print(total_scores)
+            #print(lexicon[word])
+        #print(gram.weights.matrix)
         #print(weights)
 
         for rule, val in list(weights.items()):
@@ -262,12 +252,8 @@ while True:
             level += 1
             if level == 2:
                 window["-DESCRIPTION-"].update(level2)
-                #gram.extend_crude_lexicon(2)
-                #update_crude_rules(2, crude_rule)
             elif level == 3:
                 window["-DESCRIPTION-"].update(level3)
-                #gram.extend_crude_lexicon(3)
-                #update_crude_rules(3, crude_rule)
             elif level == 4:
                 window["-DESCRIPTION-"].update(level4)
             #else:
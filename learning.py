@@ -43,6 +43,7 @@ import random
 from collections import defaultdict
 from operator import itemgetter
 from itertools import product
+import numpy as np
 
 
 def score(x=None, y=None, phi=None, w=None):
@@ -95,6 +96,88 @@ def SGD(D=None, phi=None, classes=None, true_or_false=None, T=10, eta=0.1, outpu
                 w[f] += eta * (actual_rep[f] - predicted_rep[f])                             
     return w
 
+def VectorizedSGD(D=None, phi=None, classes=None, true_or_false=None, T=10, eta=0.1, output_transform=None):
+    """Implements the same stochastic (sub)gradient descent as `SGD`,
+    but each candidate in `classes` is featurized only once per input
+    `x` and the costs of all candidates are computed only once per
+    training example. The T epochs of scoring and weight-updates are
+    then run as operations on NumPy arrays. The scores are summed in
+    the same order as in `score` and the random choices are the same as
+    in `SGD`, so under the same random seed both return the same
+    weights."""
+    candidates = list(dict.fromkeys(classes))
+    # Column of each feature in the weight vector, column 0 is a padding
+    # feature whose weight stays 0:
+    feature_ids = {}
+    # Per input x: the features of the candidates (in the order of phi)
+    # and their ids and counts with one row per candidate:
+    inputs = {}
+    for x, y in D:
+        if x not in inputs:
+            reps = [list(phi(x, y_alt).items()) for y_alt in candidates]
+            width = max([len(rep) for rep in reps] + [0])
+            ids = np.zeros((len(candidates), width), dtype=int)
+            counts = np.zeros((len(candidates), width))
+            for i, rep in enumerate(reps):
+                for j, (f, count) in enumerate(rep):
+                    ids[i, j] = feature_ids.setdefault(f, len(feature_ids) + 1)
+                    counts[i, j] = count
+            inputs[x] = (reps, ids, counts)
+    # Per training example: the features of y and the costs of all candidates:
+    examples = []
+    for x, y in D:
+        actual_rep = phi(x, y)
+        for f in actual_rep:
+            feature_ids.setdefault(f, len(feature_ids) + 1)
+        examples.append((x, actual_rep, np.array([cost(y, y_alt) for y_alt in candidates])))
+    # The dense feature vectors of the candidates and of the examples:
+    n_features = len(feature_ids) + 1
+    dense = {}
+    for x, (reps, ids, counts) in inputs.items():
+        dense[x] = np.zeros((len(candidates), n_features))
+        np.add.at(dense[x], (np.arange(len(candidates)).repeat(ids.shape[1]), ids.ravel()), counts.ravel())
+    actual_dense = []
+    for x, actual_rep, costs in examples:
+        actual_dense.append(np.zeros(n_features))
+        for f, count in actual_rep.items():
+            actual_dense[-1][feature_ids[f]] = count
+    w_vec = np.zeros(n_features)
+    # SGD adds the features to its weights when it scores the candidates
+    # of an input for the first time and in the weight-update, in this order:
+    w_order = {}
+    scored = set()
+    # Shuffling the indices permutes them in the same way as shuffling D:
+    order = list(range(len(D)))
+    for t in range(T):
+        random.shuffle(order)
+        for k in order:
+            x, actual_rep, costs = examples[k]
+            reps, ids, counts = inputs[x]
+            if x not in scored:
+                scored.add(x)
+                for rep in reps:
+                    w_order.update((f, None) for f, count in rep)
+            # Sum the weights of the features in the same order as `score`:
+            scores = np.zeros(len(candidates))
+            for j in range(ids.shape[1]):
+                scores = scores + w_vec[ids[:, j]] * counts[:, j]
+            scores = scores + costs
+            # Get all the candidates with the max score and choose one randomly:
+            y_tildes = np.flatnonzero(scores == scores.max()).tolist()
+            y_tilde = random.choice(y_tildes)
+            # Weight-update:
+            if any(f not in w_order for f in actual_rep):
+                for f in set(list(actual_rep.keys()) + [f for f, count in reps[y_tilde]]):
+                    w_order.setdefault(f)
+            w_vec = w_vec + eta * (actual_dense[k] - dense[x][y_tilde])
+    # SGD shuffles D itself:
+    D[:] = [D[k] for k in order]
+    w_list = w_vec.tolist()
+    w = defaultdict(float)
+    for f in w_order:
+        w[f] = w_list[feature_ids[f]]
+    return w
+
 def LatentSGD(D=None, phi=None, classes=None, T=10, eta=0.1, output_transform=None):
     """Implements stochatic (sub)gradient descent for the latent SVM
     objective, as in the paper. classes is defined as GEN(x, d) for
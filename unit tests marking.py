@@ -1,7 +1,12 @@
 import unittest
+import random
+from collections import defaultdict
 from grammar import *
 from world import *
 from BlockPictureGenerator import *
+import floating_grammar
+from learning import SGD, VectorizedSGD
+from Semantic_Learner import phi_sem
 
 """
 unit tests for debugging and testing that the guessed blocks are generated correctly
@@ -24,6 +29,35 @@ test_pic.block_n = len(test_pic.blocks)
 test_pic.grid = all_blocks_grid
 create_all_blocks(test_pic)
 
+# the floating parser evaluates its formulas w.r.t. the test picture in its own context
+floating_context = EvaluationContext()
+floating_grammar.create_all_blocks(test_pic, floating_context)
+
+
+def crude_floating_grammar(words, level=3, functions=floating_grammar.functions, weights=None):
+    """
+    :param words: list of strings
+    :param level: int, the level of the crude rules, see CrudeRules
+    :param functions: floating_grammar.functions or floating_grammar.bitset_functions
+    :param weights: function of a word and a logical form returning the weight of the crude rule, or None if all
+                    weights should stay 0
+    :return: floating Grammar whose lexicon maps the words to the crude rules allowed at the level
+    """
+    floating_gram = floating_grammar.Grammar({}, floating_grammar.rules, functions)
+    floating_grammar.CrudeRules(level).add_words(floating_gram, words)
+    if weights is not None:
+        for word in words:
+            for categorie, function in floating_gram.entries[word]:
+                floating_gram.update_weight(word, function, weights(word, function))
+    return floating_gram
+
+
+def gold_weight(word, function):
+    """
+    :return: 1 if the logical form is a rule of the word in the gold lexicon, 0 otherwise
+    """
+    return int(function in [entry[1] for entry in floating_grammar.gold_lexicon_basic.get(word, [])])
+
 
 test_set = [
     ('there is a square', True, {(4,1)}),
@@ -164,6 +198,347 @@ class MyTestCase(unittest.TestCase):
                 self.assertEqual(t, seman)
                 self.assertEqual(g, set(guess))
 
+    def test_denotation_cache(self):
+        # parsing an utterance again for the same picture reuses the stored denotations of its subformulas
+        u = 'there is a blue circle over a yellow circle'
+        first = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in gram.gen(u)}
+        hits = denotation_cache.hits
+        second = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in gram.gen(u)}
+        self.assertGreater(denotation_cache.hits, hits)
+        self.assertEqual(first, second)
+
+    def test_bitset_backend(self):
+        # the bitset backend gives the same truth values and guessed blocks as the object backend
+        bitset_gram = Grammar(gold_lexicon, rules, bitset_functions)
+        for test_ins in test_set + test_sentences_conj + test_sentences_pos + nested_test_sentences + special_sentences:
+            u = test_ins[0]
+            objects = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in gram.gen(u)}
+            bitsets = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in bitset_gram.gen(u)}
+            self.assertEqual(objects, bitsets)
+
+    def test_attribute_index(self):
+        # looking up colours and shapes in the attribute index finds the same blocks as calling lambda conditions
+        blocks = test_pic.blocks
+        index = picture_context.attribute_index
+        for colour in ("blue", "red", "green", "yellow"):
+            for shape in ("rectangle", "triangle", "circle"):
+                conditions = [has_colour(colour), has_shape(shape)]
+                lambdas = [(lambda b: b.colour == colour), (lambda b: b.shape == shape)]
+                self.assertEqual(set(block_filter(conditions, blocks, index)), set(block_filter(lambdas, blocks)))
+        self.assertEqual(block_filter([has_colour("red"), has_colour("blue")], blocks, index), [])
+
+    def test_large_grid(self):
+        # on a 16x16 grid the relations found by binary search or with the position index of the picture are the same
+        # as comparing every pair of blocks
+        big_pic = Picture(complexity=(200, 201), name="big", dim=16)
+        self.assertEqual(len(big_pic.grid), 16)
+        self.assertEqual(len(big_pic.coordinates), 16)
+        create_all_blocks(big_pic)
+        try:
+            blocks, block_locations = big_pic.blocks[:100], big_pic.blocks[100:]
+            tests = {"u": lambda b1, b2: b1.y > b2.y, "o": lambda b1, b2: b1.y < b2.y,
+                     "n": lambda b1, b2: b1.y == b2.y and b1.x != b2.x,
+                     "l": lambda b1, b2: b1.x < b2.x, "r": lambda b1, b2: b1.x > b2.x}
+            for position, test in tests.items():
+                found = position_test(blocks, block_locations, range(3, 200), position)
+                expected = [b1 for b1 in blocks if sum(test(b1, b2) for b2 in block_locations) >= 3]
+                self.assertEqual(found, expected)
+                indexed = position_test(blocks, block_locations, range(3, 200), position,
+                                        picture_context.position_index)
+                self.assertEqual(indexed, expected)
+                self.assertEqual({b1: set(related(parts)) for b1, parts in indexed.back_track.items()},
+                                 {b1: set(related(parts)) for b1, parts in found.back_track.items()})
+            bitset_gram = Grammar(gold_lexicon, rules, bitset_functions)
+            for u in ('there are three blue circles', 'there is a red triangle under a blue square'):
+                objects = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in gram.gen(u)}
+                bitsets = {(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in bitset_gram.gen(u)}
+                self.assertEqual(objects, bitsets)
+        finally:
+            create_all_blocks(test_pic)
+
+    def test_evaluation_contexts(self):
+        # several pictures can be evaluated at the same time in their own contexts, also in parallel threads
+        from concurrent.futures import ThreadPoolExecutor
+        pictures = [test_pic] + [Picture(name="context") for i in range(3)]
+        contexts = []
+        for pic in pictures:
+            context = EvaluationContext()
+            create_all_blocks(pic, context)
+            contexts.append(context)
+        utterances = [test_ins[0] for test_ins in test_set + test_sentences_pos + nested_test_sentences]
+
+        def parse_all(context):
+            # the CKY parser keeps the parse forest of the last utterance, so each thread needs its own Grammar
+            context_gram = Grammar(gold_lexicon, rules, functions)
+            return [{(lf.formular, lf.semantic, frozenset(lf.guessed_blocks))
+                     for lf in context_gram.gen(u, context=context)} for u in utterances]
+
+        sequential = [parse_all(context) for context in contexts]
+        with ThreadPoolExecutor(len(contexts)) as executor:
+            parallel = list(executor.map(parse_all, contexts))
+        self.assertEqual(sequential, parallel)
+        # the context of the test picture gives the same results as the current picture
+        self.assertEqual(sequential[0], parse_all(picture_context))
+
+    def test_picture_filter(self):
+        # deferring the lexical rules that are empty on the picture does not change the results of the floating parser
+        small_pic = Picture(complexity=(3, 4), name="filter")
+        context = EvaluationContext()
+        floating_grammar.create_all_blocks(small_pic, context)
+        for u in ('a triangle', 'two blue forms', 'circle under a square'):
+            for fs in (floating_grammar.functions, floating_grammar.bitset_functions):
+                # the crude rules of level 2 contain no disjunctions, see test_picture_filter_disjunction
+                floating_gram = crude_floating_grammar(u.split(), level=2, functions=fs)
+                full = {(lf.formular, frozenset(lf.guessed_blocks)) for lf in floating_gram.gen(u, context=context)}
+                filtered = {(lf.formular, frozenset(lf.guessed_blocks))
+                            for lf in floating_gram.gen(u, context=context, prefilter=True)}
+                # at most three of the four colours occur in the picture
+                self.assertGreater(floating_gram.n_deferred, 0)
+                self.assertEqual(full, filtered)
+
+    def test_picture_filter_disjunction(self):
+        # no lexical rule is deferred for an utterance with a disjunction, even if one side is empty on the picture
+        u = 'a circle or a square'
+        context = EvaluationContext()
+        context.update([b for b in test_pic.blocks if b.shape != "circle"])
+        floating_gram = floating_grammar.Grammar(floating_grammar.gold_lexicon_basic, floating_grammar.rules,
+                                                 floating_grammar.functions)
+        full = {(lf.formular, lf.components) for lf in floating_gram.gen(u, context=context)}
+        filtered = {(lf.formular, lf.components) for lf in floating_gram.gen(u, context=context, prefilter=True)}
+        self.assertEqual(floating_gram.n_deferred, 0)
+        self.assertEqual(full, filtered)
+        # the parses in which the empty circles are the false side of the disjunction are kept
+        self.assertTrue(any(formular.startswith('xoder') and 'circle' in formular for formular, components in full))
+        self.assertTrue(any(formular.startswith('oder') and 'circle' in formular for formular, components in full))
+        # without the disjunction the circles are deferred
+        floating_gram.gen('a circle', context=context, prefilter=True)
+        self.assertEqual(floating_gram.n_deferred, 1)
+
+    def test_crude_rules(self):
+        # a word only gets the crude rules of the current level, its entry is widened when the level rises
+        registry = floating_grammar.CrudeRules(level=1)
+        floating_gram = crude_floating_grammar([])
+        added = registry.add_words(floating_gram, ['a', 'circle', 'a'])
+        self.assertEqual(len(added), 2 * len(floating_gram.lexicon['a']))
+        self.assertEqual({entry[0] for entry in floating_gram.lexicon['circle']}, {'B', 'N'})
+        registry.update_level(floating_gram, 2)
+        self.assertEqual({entry[0] for entry in floating_gram.lexicon['circle']}, {'B', 'N', 'C'})
+        registry.update_level(floating_gram, 4)
+        registry.add_words(floating_gram, ['under'])
+        for word in ('a', 'circle', 'under'):
+            self.assertEqual(sorted(floating_gram.lexicon[word]), sorted(floating_grammar.create_lex_rules()))
+
+    def test_lexicon_updates(self):
+        # changing the lexicon of a grammar gives the same parses as creating the grammar again from the lexicon
+        u = 'circle under a square'
+        floating_gram = crude_floating_grammar([])
+        self.assertNotIn('B', floating_gram.leaves_to_v)
+        floating_grammar.CrudeRules(level=3).add_words(floating_gram, u.split())
+        version = floating_gram.version
+        floating_gram.update_weight('circle', 'block_filter([has_shape("circle")], allblocks)', 1)
+        self.assertEqual(floating_gram.version, version + 1)
+        for entry in floating_gram.lexicon['under'][:]:
+            if entry[0] != 'POS':
+                floating_gram.delete_rule('under', entry[1])
+        self.assertEqual(set(floating_gram.lexical_categories), {'B', 'N', 'C', 'POS', 'CONJ'})
+        rebuilt = floating_grammar.Grammar(floating_gram.lexicon, floating_grammar.rules, floating_grammar.functions)
+        self.assertEqual(floating_gram.leaves_to_v, rebuilt.leaves_to_v)
+        parses = {(lf.formular, lf.components, lf.summed_weights)
+                  for lf in floating_gram.gen(u, context=floating_context)}
+        self.assertEqual(parses, {(lf.formular, lf.components, lf.summed_weights)
+                                  for lf in rebuilt.gen(u, context=floating_context)})
+        self.assertIn(1, {weight for formular, components, weight in parses})
+
+    def test_weight_table(self):
+        # adding the learned weights to the weight matrix and deleting the rules below the threshold gives the same
+        # lexicon as updating the weights of the rules one by one
+        floating_gram = crude_floating_grammar(['a', 'red', 'circle'])
+        learned = {('red', 'red'): 0.2, ('red', 'blue'): -0.2, ('circle', 'red'): -0.05, ('', 'anycol'): 0.1,
+                   ('top', 'R', 'exist'): 1.0}
+        expected = {word: {function: weight + 2 * learned.get((word, function), 0) for c, function, weight in entries}
+                    for word, entries in floating_gram.lexicon.items()}
+        del expected['red']['blue']
+        floating_gram.add_weights(learned)
+        self.assertEqual(floating_gram.delete_below(-0.3), [])
+        floating_gram.add_weights(learned)
+        self.assertEqual(floating_gram.delete_below(-0.3), [('red', 'blue')])
+        self.assertEqual({word: {function: weight for c, function, weight in entries}
+                          for word, entries in floating_gram.lexicon.items()}, expected)
+        self.assertNotIn('blue', {function for c, function in floating_gram.entries['red']})
+
+    def test_vectorized_sgd(self):
+        # under the same random seed the vectorized learner returns the same weights as SGD
+        u = 'two blue forms'
+        floating_gram = crude_floating_grammar(u.split(), level=2)
+        parse = floating_gram.gen(u, context=floating_context)
+        groups, sorted_guesses = floating_grammar.grouping(parse)
+        weights = []
+        for optimizer in (SGD, VectorizedSGD):
+            random.seed(0)
+            weights.append(optimizer(D=[[u, lf] for lf in groups[sorted_guesses[0]]], phi=phi_sem, classes=parse,
+                                     T=10, eta=0.1))
+        self.assertTrue(weights[0])
+        self.assertEqual(list(weights[0].items()), list(weights[1].items()))
+
+    def test_beam(self):
+        # in beam mode no cell of formulas built from more than one subformula holds more than beam ParseItems
+        u = 'two blue forms'
+        words = u.split()
+        floating_gram = crude_floating_grammar(words, weights=gold_weight)
+        chart = defaultdict(lambda: defaultdict(floating_gram.item_index))
+        for item in floating_gram.fill_chart(words, chart, beam=5, context=floating_context):
+            pass
+        self.assertGreater(floating_gram.n_pruned, 0)
+        for categorie in chart:
+            for s, cell in chart[categorie].items():
+                if s > 1:
+                    self.assertLessEqual(len(cell), 5)
+        # ties are broken by the order of the ParseItems, so the same ParseItems are kept each time
+        pruned = floating_gram.n_pruned
+        beam_results = {(lf.formular, lf.components) for lf in floating_gram.gen(u, beam=5, context=floating_context)}
+        self.assertEqual(floating_gram.n_pruned, pruned)
+        self.assertEqual(beam_results,
+                         {(lf.formular, lf.components) for lf in floating_gram.gen(u, beam=5, context=floating_context)})
+        # without a beam, or with a beam that no cell reaches, nothing is pruned
+        full = {(lf.formular, lf.components) for lf in floating_gram.gen(u, context=floating_context)}
+        self.assertEqual({(lf.formular, lf.components) for lf in floating_gram.gen(u, beam=None, context=floating_context)},
+                         full)
+        self.assertEqual(floating_gram.n_pruned, 0)
+        self.assertEqual({(lf.formular, lf.components) for lf in floating_gram.gen(u, beam=10**6, context=floating_context)},
+                         full)
+        self.assertEqual(floating_gram.n_pruned, 0)
+        self.assertLessEqual(beam_results, full)
+        with self.assertRaises(ValueError):
+            floating_gram.gen(u, beam=0, context=floating_context)
+        with self.assertRaises(ValueError):
+            next(floating_gram.gen_stream(u, beam=0, context=floating_context))
+
+    def test_gen_best(self):
+        # the best-first mode finds the guesses with the same weights as grouping all results of the exhaustive parser
+        u = 'a red circle'
+        words = u.split()
+        rng = random.Random(3)
+        for trial in range(3):
+            # random weights including negative ones
+            floating_gram = crude_floating_grammar(words, weights=lambda word, function:
+                                                   rng.choice((-1, -0.5, 0, 0.5, 1)))
+            groups, guesses = floating_grammar.grouping(floating_gram.gen(u, context=floating_context))
+            weights = [groups[guess][0].summed_weights for guess in guesses]
+            # k larger than the number of guesses returns all guesses
+            for k in (1, 3, len(guesses) + 5):
+                best_groups, best_guesses = floating_gram.gen_best(u, k, context=floating_context)
+                self.assertEqual([best_groups[guess][0].summed_weights for guess in best_guesses], weights[:k])
+            self.assertEqual(set(best_guesses), set(guesses))
+
+    def test_gen_stream(self):
+        # the streaming parser yields the same formulas as gen unless it is cut off
+        u = 'a red circle'
+        words = u.split()
+        floating_gram = crude_floating_grammar(words)
+        full = {(lf.formular, lf.components) for lf in floating_gram.gen(u, context=floating_context)}
+        streamed = [(lf.formular, lf.components) for lf in floating_gram.gen_stream(u, context=floating_context)]
+        self.assertEqual(set(streamed), full)
+        self.assertEqual(len(streamed), len(full))
+        self.assertFalse(floating_gram.cut_off)
+        # with max_items the parser stops after the ParseItem with which that many were added to the parse chart
+        chart = defaultdict(lambda: defaultdict(floating_gram.item_index))
+        added = list(floating_gram.fill_chart(words, chart, context=floating_context))
+        max_items = len(added) // 2
+        expected = []
+        for item in added[:max_items]:
+            if item.c == 'V':
+                floating_gram.evaluate(item, floating_context)
+                if item.semantic:
+                    expected.append((item.formular, item.components))
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), len(full))
+        self.assertEqual([(lf.formular, lf.components)
+                          for lf in floating_gram.gen_stream(u, max_items=max_items, context=floating_context)],
+                         expected)
+        self.assertTrue(floating_gram.cut_off)
+
+    def test_merge_equivalent(self):
+        # merging formulas with the same denotation keeps every guess with its highest weight
+        def guess_weights(results):
+            groups, guesses = floating_grammar.grouping(results)
+            return {(guess, groups[guess][0].summed_weights) for guess in guesses}
+
+        rng = random.Random(5)
+        for u in ('a red circle', 'circle under a square'):
+            words = u.split()
+            for fs in (floating_grammar.functions, floating_grammar.bitset_functions):
+                floating_gram = crude_floating_grammar(words, functions=fs,
+                                                       weights=lambda word, function: rng.choice((-1, 0, 1)))
+                full = floating_gram.gen(u, context=floating_context)
+                merged = floating_gram.gen(u, merge_equivalent=True, context=floating_context)
+                self.assertGreater(floating_gram.n_merged, 0)
+                self.assertEqual(guess_weights(full), guess_weights(merged))
+
+    def test_nested_floating(self):
+        # the floating parser finds the guess of the nested positional description with the gold lexicon, this needs
+        # the rule ('POS_NB', 'BC', 'BC') that turns a positional description into a BC that can be positioned again
+        u = 'a blue triangle under a red triangle under a yellow triangle'
+        g = nested_test_sentences[0][2]
+        for fs in (floating_grammar.functions, floating_grammar.bitset_functions):
+            floating_gram = floating_grammar.Grammar(floating_grammar.gold_lexicon_basic, floating_grammar.rules, fs)
+            guesses = {frozenset((b.y, b.x) for b in lf.guessed_blocks)
+                       for lf in floating_gram.gen(u, context=floating_context) if lf.formular.count('under') == 2}
+            self.assertIn(frozenset(g), guesses)
+        # without the rule the guess is not found
+        rules = [rule for rule in floating_grammar.rules if rule != ('POS_NB', 'BC', 'BC')]
+        floating_gram = floating_grammar.Grammar(floating_grammar.gold_lexicon_basic, rules, floating_grammar.functions)
+        guesses = {frozenset((b.y, b.x) for b in lf.guessed_blocks)
+                   for lf in floating_gram.gen(u, context=floating_context)}
+        self.assertNotIn(frozenset(g), guesses)
+
+    def test_bitset_grouping(self):
+        # with the bitset backend the formulas are grouped by the bitmasks of their guessed blocks, which gives the
+        # same groups as grouping the Block objects
+        object_gram = floating_grammar.Grammar(floating_grammar.gold_lexicon_basic, floating_grammar.rules,
+                                               floating_grammar.functions)
+        bitset_gram = floating_grammar.Grammar(floating_grammar.gold_lexicon_basic, floating_grammar.rules,
+                                               floating_grammar.bitset_functions)
+        for u in ('a red triangle and a green square', 'a triangle over a square', 'a yellow circle'):
+            groups, guesses = floating_grammar.grouping(object_gram.gen(u, context=floating_context))
+            bitset_groups, bitset_guesses = floating_grammar.grouping(bitset_gram.gen(u, context=floating_context))
+            self.assertTrue(all(isinstance(guess, floating_grammar.BlockSet) for guess in bitset_guesses))
+            # iterating a BlockSet gives the Block objects, e.g. to mark the guess in the picture
+            self.assertEqual({frozenset(guess): {lf.formular for lf in groups[guess]} for guess in guesses},
+                             {frozenset(guess): {lf.formular for lf in bitset_groups[guess]} for guess in bitset_guesses})
+            best_groups, best_guesses = bitset_gram.gen_best(u, 2, context=floating_context)
+            self.assertEqual([best_groups[guess][0].summed_weights for guess in best_guesses],
+                             [groups[guess][0].summed_weights for guess in guesses[:2]])
+
+    def test_formula_table(self):
+        # a Grammar that parses several utterances in a row only keeps the formulas, the components of each parse are
+        # released together with its ParseItems
+        floating_gram = floating_grammar.Grammar({}, floating_grammar.rules, floating_grammar.functions)
+        crude_rules = floating_grammar.CrudeRules(level=3)
+        n_formulas = []
+        for u in ('a red circle', 'two blue forms', 'circle under square', 'one green square'):
+            words = u.split()
+            crude_rules.add_words(floating_gram, words)
+            results = floating_gram.gen(u, context=floating_context)
+            self.assertGreater(len(results), 0)
+            self.assertTrue(all({word for word, function in lf.components} <= set(words) | {''} for lf in results))
+            self.assertEqual(len(floating_gram.table.component_sets), 0)
+            n_formulas.append(len(floating_gram.table.formulas))
+        # the crude rules of all words are the same, so no formula is added after the first utterance
+        self.assertEqual(len(set(n_formulas)), 1)
+
+    def test_lazy_trees(self):
+        # counting the trees in the packed parse forest and building only the first max_trees of them give the same
+        # trees as evaluating all trees of the forest
+        u = 'there is a red circle'
+        crude_rules = create_lex_rules()
+        crude_gram = Grammar({word: crude_rules for word in u.split()}, rules, functions)
+        full = [(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in crude_gram.gen(u)]
+        self.assertEqual(crude_gram.count_trees(("V", 0, len(u.split()))), len(full))
+        self.assertTrue(any(semantic for formular, semantic, guesses in full))
+        for k in (0, 1, 50, len(full), len(full) + 10):
+            lazy = [(lf.formular, lf.semantic, frozenset(lf.guessed_blocks)) for lf in crude_gram.gen(u, max_trees=k)]
+            self.assertEqual(lazy, full[:k])
+
 
 if __name__ == '__main__':
     unittest.main()